@@ -0,0 +1,174 @@
+import asyncio
+import collections
+import logging
+import random
+from typing import Deque, Dict, List, Optional
+
+from .metrics import ADMISSION, JOIN_WAIT, RPC_IN_FLIGHT
+from .scheduling import Priority
+
+logger = logging.getLogger(__name__)
+
+# Calls that free Kurento resources or keep the link up are never held back
+UNBUDGETED_METHODS = frozenset({'ping', 'release', 'unsubscribe'})
+
+
+class TryLater(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f'TryLater: {self.reason}, retry after {self.retry_after:.1f}s'
+
+
+class InFlightBudget:
+    """Requests in flight toward Kurento over all links of a pool.
+
+    Callers wait in ``wait`` until ``count`` more fit under ``limit`` and
+    then ``take`` them without awaiting in between, like the per-link
+    PendingRequests room. Waiters are woken by Priority, in order within one.
+    """
+
+    def __init__(self, limit: int = 256, name: str = ''):
+        self.limit = limit
+        self.in_flight = 0
+        self.waited = 0
+        self._waiters: List[Deque[asyncio.Future]] = [collections.deque() for _ in Priority]
+        RPC_IN_FLIGHT.labels(name).set_function(lambda: self.in_flight)
+
+    async def wait(self, count: int = 1, priority: Priority = Priority.NORMAL):
+        count = min(count, self.limit)
+        if self.in_flight + count > self.limit:
+            self.waited += 1
+        while self.in_flight + count > self.limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters[priority].append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_next()
+                raise
+        if self.in_flight + count < self.limit:
+            self._wake_next()
+
+    def take(self, count: int = 1):
+        self.in_flight += count
+
+    def give(self, count: int = 1):
+        self.in_flight -= count
+        self._wake_next()
+
+    def _wake_next(self):
+        for waiters in self._waiters:
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+
+    @property
+    def stats(self) -> Dict:
+        return {'in_flight': self.in_flight, 'limit': self.limit, 'waiting': sum(map(len, self._waiters)),
+                'waited': self.waited}
+
+
+class TokenBucket:
+    """``rate`` tokens per second, at most ``burst`` saved up."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = asyncio.get_event_loop().time()
+
+    def take(self, cost: float = 1.0) -> bool:
+        now = asyncio.get_event_loop().time()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class JoinGate:
+    """At most ``concurrency`` joins at a time, the next ``max_queued`` wait in order.
+
+    A join that finds the queue full, or waits longer than ``max_wait``, gets
+    TryLater right away with a jittered retry hint derived from the queue
+    length and the recent join time, so a reconnect storm spreads out
+    instead of coming back at once.
+    """
+
+    def __init__(self, concurrency: int = 16, max_queued: int = 256, max_wait: float = 5.0):
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        self.join_time = 0.5
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+
+    def retry_after(self) -> float:
+        backlog = (self.queued + self.active) / self.concurrency * self.join_time
+        return min(30.0, max(1.0, backlog)) * random.uniform(1.0, 2.0)
+
+    async def enter(self):
+        if self.active < self.concurrency and not self.queued:
+            self.active += 1
+            ADMISSION.labels('join', 'admitted').inc()
+            return
+        if self.queued >= self.max_queued:
+            ADMISSION.labels('join', 'rejected').inc()
+            raise TryLater('join queue full', self.retry_after())
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just now; pass it on
+                self.leave()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            ADMISSION.labels('join', 'timed_out').inc()
+            raise TryLater('join queue too slow', self.retry_after()) from None
+        finally:
+            self.queued -= 1
+        JOIN_WAIT.labels().observe(loop.time() - start)
+        ADMISSION.labels('join', 'admitted').inc()
+
+    def leave(self, elapsed: Optional[float] = None):
+        if elapsed is not None:
+            self.join_time += (elapsed - self.join_time) * 0.2
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot goes straight to the next waiter
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @property
+    def stats(self) -> Dict:
+        return {'active': self.active, 'queued': self.queued, 'join_time': self.join_time}
+
+
+class Admission:
+    """What the /ws handler admits: joins through a JoinGate, messages through a bucket per client."""
+
+    def __init__(self, join_concurrency: int = 16, join_queue: int = 256, join_wait: float = 5.0,
+                 rate: float = 20.0, burst: float = 60.0):
+        self.joins = JoinGate(join_concurrency, join_queue, join_wait)
+        self.rate = rate
+        self.burst = burst
+
+    def bucket(self) -> TokenBucket:
+        return TokenBucket(self.rate, self.burst)
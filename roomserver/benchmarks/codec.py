@@ -0,0 +1,59 @@
+import argparse
+import time
+from typing import Any, Dict, List
+
+from roomserver.benchmarks.messages import SHAPES, captured_sets
+from roomserver.codec import codecs
+
+
+def measure(fn, args: List, number: int) -> float:
+    # Microseconds per call, averaged over ``args``
+    start = time.perf_counter()
+    for _ in range(number):
+        for arg in args:
+            fn(arg)
+    return (time.perf_counter() - start) / number / len(args) * 1e6
+
+
+def shape_of(message: Any) -> str:
+    if isinstance(message, list):
+        return 'batch'
+    if 'method' in message:
+        return message['method'] if message['method'] != 'invoke' else message['params'].get('operation', 'invoke')
+    if 'type' in message:
+        return message['type']
+    return 'error' if 'error' in message else 'reply'
+
+
+def captured_shapes(path: str) -> Dict[str, List]:
+    shapes: Dict[str, List] = {}
+    for peer, messages in captured_sets(path).items():
+        for message in messages:
+            shapes.setdefault(f'{peer} {shape_of(message)}', []).append(message)
+    return shapes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare JSON codecs on Kurento message shapes')
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    parser.add_argument('--capture', metavar='PATH',
+                        help='use the messages of a recording made with rs --record, grouped by method or type')
+    args = parser.parse_args()
+
+    if args.capture:
+        shapes = captured_shapes(args.capture)
+    else:
+        shapes = {shape: [factory()] for shape, factory in SHAPES.items()}
+    print(f'{"shape":24} {"codec":8} {"bytes":>8} {"dumps us":>10} {"loads us":>10}')
+    for shape, messages in shapes.items():
+        for name, codec_class in codecs.items():
+            codec = codec_class()
+            payloads = [codec.dumps(message) for message in messages]
+            dumps = measure(codec.dumps, messages, args.number)
+            loads = measure(codec.loads, payloads, args.number)
+            size = sum(map(len, payloads)) // len(payloads)
+            print(f'{shape:24} {name:8} {size:8} {dumps:10.2f} {loads:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
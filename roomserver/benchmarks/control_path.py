@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+from typing import Awaitable, Callable, List
+
+from roomserver.kms_emulator import running_emulator
+from roomserver.media.pipeline import MediaPipeline
+from roomserver.media.session import KurentoSession, JsonRPCProtocol, JsonRPCBase
+from roomserver.media.web_rtc_endpoint import WebRTCEndPoint
+from roomserver.transport import WebSocketClient
+
+
+class Result:
+    def __init__(self, name: str, latencies: List[float], errors: int, elapsed: float):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return float('nan')
+        return self.latencies[min(len(self.latencies) - 1, int(len(self.latencies) * p))]
+
+    def __str__(self):
+        calls = len(self.latencies) + self.errors
+        jitter = statistics.pstdev(self.latencies) if self.latencies else float('nan')
+        return (f'{self.name:10} {calls / self.elapsed:10.0f} calls/s'
+                f'  p50 {self.percentile(0.5) * 1e3:7.3f} ms  p99 {self.percentile(0.99) * 1e3:7.3f} ms'
+                f'  stdev {jitter * 1e3:7.3f} ms  errors {self.errors}')
+
+
+async def measure(name: str, call: Callable[[], Awaitable[bool]], number: int, concurrency: int) -> Result:
+    latencies: List[float] = []
+    errors = 0
+    remaining = number
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                ok = await call()
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return Result(name, latencies, errors, time.perf_counter() - start)
+
+
+async def run(args):
+    emulator_kwargs = dict(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=1)
+    async with running_emulator(**emulator_kwargs) as (emulator, url):
+        async with WebSocketClient(url) as client:
+            base = JsonRPCBase()
+            async with JsonRPCProtocol(client, base) as protocol:
+                session = KurentoSession(protocol)
+                runner = asyncio.create_task(client.run())
+
+                async def protocol_ping():
+                    request, future = base.create_request('ping', {'interval': 0})
+                    await client.send_message(request)
+                    return (await future)['value'] == 'pong'
+
+                async def session_ping():
+                    return (await (await session.send_request('ping', {'interval': 0})))['value'] == 'pong'
+
+                async def create_pipeline():
+                    pipeline = MediaPipeline(session)
+                    await pipeline.create()
+                    return pipeline.pipeline_id is not None
+
+                pipeline = MediaPipeline(session)
+                while pipeline.pipeline_id is None:
+                    await pipeline.create()
+
+                async def create_endpoint():
+                    endpoint = WebRTCEndPoint(pipeline, session)
+                    await endpoint.create()
+                    return endpoint.element_id is not None
+
+                benchmarks = {
+                    'protocol': protocol_ping,
+                    'session': session_ping,
+                    'pipeline': create_pipeline,
+                    'endpoint': create_endpoint,
+                }
+                print(f'latency {args.latency}s jitter {args.jitter}s error rate {args.error_rate}'
+                      f' - {args.number} calls, {args.concurrency} concurrent')
+                for name, call in benchmarks.items():
+                    if args.only and name not in args.only:
+                        continue
+                    print(await measure(name, call, args.number, args.concurrency))
+                print('emulator served', emulator.requests, 'requests', 'pending table', base.stats)
+                runner.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roomserver control path against the Kurento emulator')
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--only', nargs='*', choices=['protocol', 'session', 'pipeline', 'endpoint'])
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
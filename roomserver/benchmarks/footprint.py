@@ -0,0 +1,91 @@
+import argparse
+import asyncio
+import gc
+import logging
+import sys
+import tracemalloc
+
+import aiohttp
+from aiohttp import web
+
+from roomserver.room import RoomManager, RoomProtocol
+from roomserver.transport import LeanWebSocketResponse, WebSocketBase, WebSocketResponse
+
+MODES = {'classic': WebSocketResponse, 'lean': LeanWebSocketResponse}
+
+
+async def websocket_handler(request):
+    async with request.app['transport'](request) as response:
+        async with RoomProtocol(response, request.app['rooms']):
+            await response.run()
+    return response.ws
+
+
+async def client(url: str, connections: int):
+    # Runs in a child process so only the server side is measured
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        sockets = []
+        for start in range(0, connections, 100):
+            sockets.extend(await asyncio.gather(*(session.ws_connect(url)
+                                                  for _ in range(min(100, connections - start)))))
+        print('ready', flush=True)
+        await asyncio.get_event_loop().run_in_executor(None, sys.stdin.readline)
+        await asyncio.gather(*(ws.close() for ws in sockets))
+
+
+def measure() -> tuple:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0], len(asyncio.all_tasks())
+
+
+async def run_mode(mode: str, connections: int, port: int):
+    app = web.Application()
+    app['transport'] = MODES[mode]
+    app['rooms'] = RoomManager(lambda room_id: None)
+    app.add_routes([web.get('/ws', websocket_handler)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    tracemalloc.start()
+    memory, tasks = measure()
+    child = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'roomserver.benchmarks.footprint', '--client', f'ws://127.0.0.1:{port}/ws',
+        '-c', str(connections), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+    await child.stdout.readline()
+    while len(WebSocketBase.sockets.get('browser', ())) < connections:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+    idle_memory, idle_tasks = measure()
+    tracemalloc.stop()
+
+    child.stdin.write(b'\n')
+    await child.stdin.drain()
+    await child.wait()
+    await runner.cleanup()
+    print(f'{mode:8} {connections:6} {(idle_memory - memory) / connections:12.0f}'
+          f' {(idle_tasks - tasks) / connections:10.2f}')
+
+
+async def run(args):
+    print(f'{"mode":8} {"conns":>6} {"bytes/conn":>12} {"tasks/conn":>10}')
+    for mode in args.mode or MODES:
+        await run_mode(mode, args.connections, args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Server memory and tasks per idle /ws connection')
+    parser.add_argument('-c', '--connections', type=int, default=1000)
+    parser.add_argument('-p', '--port', type=int, default=8790)
+    parser.add_argument('--mode', choices=MODES, action='append', help='transports to measure, default all')
+    parser.add_argument('--client', metavar='URL', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    if args.client:
+        asyncio.run(client(args.client, args.connections))
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
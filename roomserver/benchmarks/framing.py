@@ -0,0 +1,105 @@
+import argparse
+import time
+import zlib
+from typing import Callable, List, Optional
+
+from roomserver.benchmarks.messages import captured_sets, synthetic_browser_set, synthetic_kurento_set
+from roomserver.codec import codecs
+
+SETS = {'kurento': synthetic_kurento_set, 'browser': synthetic_browser_set}
+# The tail every sync-flushed permessage-deflate frame drops
+TAIL = b'\x00\x00\xff\xff'
+
+
+class Deflate:
+    """permessage-deflate as aiohttp does it: level 1, a shared context or a fresh one per frame."""
+
+    def __init__(self, wbits: int, shared: bool, level: int = 1):
+        self.wbits = wbits
+        self.shared = shared
+        self.level = level
+        self.reset()
+
+    def reset(self):
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits)
+        self._decompressor = zlib.decompressobj(-self.wbits)
+
+    @property
+    def state_bytes(self) -> int:
+        # zlib's own estimate of a deflate context: window plus hash table, memLevel 8
+        return (1 << (self.wbits + 2)) + (1 << (8 + 9)) if self.shared else 0
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self._compressor if self.shared else zlib.compressobj(self.level, zlib.DEFLATED, -self.wbits)
+        frame = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return frame[:-4] if frame.endswith(TAIL) else frame
+
+    def decompress(self, data: bytes) -> bytes:
+        # The receiver always keeps a window, the sender decides whether frames refer to it
+        return self._decompressor.decompress(data + TAIL)
+
+
+MODES = {
+    'none': None,
+    'deflate': lambda: Deflate(15, shared=True),
+    'deflate/frame 15': lambda: Deflate(15, shared=False),
+    'deflate/frame 12': lambda: Deflate(12, shared=False),
+    'deflate/frame 10': lambda: Deflate(10, shared=False),
+}
+
+
+def as_bytes(payload) -> bytes:
+    return payload.encode() if isinstance(payload, str) else payload
+
+
+def run_set(messages: List, codec_name: str, mode: Optional[Callable[[], Deflate]], number: int):
+    codec = codecs[codec_name]()
+    deflate = mode() if mode is not None else None
+    frames = []
+    start = time.perf_counter()
+    for _ in range(number):
+        if deflate is not None:
+            deflate.reset()
+        frames = []
+        for message in messages:
+            payload = as_bytes(codec.dumps(message))
+            frames.append(deflate.compress(payload) if deflate is not None else payload)
+    encode = (time.perf_counter() - start) / number
+    start = time.perf_counter()
+    for _ in range(number):
+        if deflate is not None:
+            deflate.reset()
+        for frame in frames:
+            codec.loads(deflate.decompress(frame) if deflate is not None else frame)
+    decode = (time.perf_counter() - start) / number
+    return sum(map(len, frames)), encode, decode, deflate.state_bytes if deflate is not None else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bytes on the wire and CPU per /ws framing option')
+    parser.add_argument('-n', '--number', type=int, default=200)
+    parser.add_argument('--set', choices=SETS, action='append', help='message sets, default all')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='take the sets from a recording made with rs --record instead of synthetic messages')
+    args = parser.parse_args()
+
+    captured = captured_sets(args.capture) if args.capture else None
+    for set_name in args.set or SETS:
+        messages = captured.get(set_name, []) if captured is not None else SETS[set_name]()
+        if not messages:
+            continue
+        baseline = None
+        print(f'{set_name}: {len(messages)} messages')
+        print(f'{"codec":8} {"compression":18} {"bytes":>8} {"ratio":>6} {"encode us":>10} {"decode us":>10}'
+              f' {"state KiB":>10}')
+        for codec_name in codecs:
+            for mode_name, mode in MODES.items():
+                size, encode, decode, state = run_set(messages, codec_name, mode, args.number)
+                baseline = baseline or size
+                print(f'{codec_name:8} {mode_name:18} {size:8} {size / baseline:6.2f} {encode * 1e6:10.1f}'
+                      f' {decode * 1e6:10.1f} {state / 1024:10.0f}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import copy
+from typing import Any, Dict, List
+
+from roomserver.codec import codecs, get_codec
+from roomserver.recording import Kind, read_records
+
+SESSION_ID = '1f73ef4e-8482-4951-87a1-4d383e1545f3'
+PIPELINE_ID = '6a4a3b7a-6b56-4b9e-9ed3-5d4e1d1b4c1e_kurento.MediaPipeline'
+ENDPOINT_ID = PIPELINE_ID + '/0f4f4c16-3a4b-4d2c-8f15-2c2a4f6a7d21_kurento.WebRtcEndpoint'
+
+
+def _sdp() -> str:
+    lines = [
+        'v=0',
+        'o=- 3794384120 3794384120 IN IP4 0.0.0.0',
+        's=Kurento Media Server',
+        'c=IN IP4 0.0.0.0',
+        't=0 0',
+        'a=msid-semantic: WMS EnU7PJbkHpVPBavb2JyNNLCqbZ7Hvi0mJ7kX',
+        'a=group:BUNDLE audio0 video0',
+    ]
+    for kind, port, codecs in (('audio', 9, (111, 0)), ('video', 9, (96, 97, 98, 99, 100, 101, 102))):
+        lines.append(f'm={kind} {port} UDP/TLS/RTP/SAVPF {" ".join(map(str, codecs))}')
+        lines.append('a=setup:actpass')
+        lines.append('a=extmap:3 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time')
+        lines.append(f'a=mid:{kind}0')
+        lines.append('a=rtcp-mux')
+        for pt in codecs:
+            name = 'opus/48000/2' if kind == 'audio' and pt == 111 else 'VP8/90000' if kind == 'video' else 'PCMU/8000'
+            lines.append(f'a=rtpmap:{pt} {name}')
+            lines.append(f'a=rtcp-fb:{pt} goog-remb')
+            lines.append(f'a=rtcp-fb:{pt} ccm fir')
+            lines.append(f'a=rtcp-fb:{pt} nack')
+            lines.append(f'a=rtcp-fb:{pt} nack pli')
+        lines.append('a=ice-ufrag:Rq8H')
+        lines.append('a=ice-pwd:Fa7fXYtpMnqoAnI4drSq0ScJ')
+        lines.append('a=fingerprint:sha-256 ' + ':'.join(['A1', 'B2', 'C3', 'D4'] * 8))
+        lines.append(f'a=ssrc:{port * 123456789 % 4294967295} cname:user2539146519@host-4f8a1f2c')
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def _stats_entry(i: int) -> Dict:
+    return {
+        'id': f'RTCInboundRTPVideoStream_{i}',
+        'timestamp': 1597305600.123 + i,
+        'type': 'inboundrtp',
+        'ssrc': str(1000 + i),
+        'associateStatsId': f'RTCRemoteOutboundRTPVideoStream_{i}',
+        'isRemote': False,
+        'mediaTrackId': f'RTCMediaStreamTrack_receiver_{i}',
+        'transportId': 'RTCTransport_video_1',
+        'codecId': 'RTCCodec_video_VP8_96',
+        'firCount': 0,
+        'pliCount': 3,
+        'nackCount': 12,
+        'sliCount': 0,
+        'qpSum': 18342,
+        'packetsReceived': 48211,
+        'bytesReceived': 52340123,
+        'packetsLost': 17,
+        'jitter': 0.0042,
+        'fractionLost': 0.0,
+        'remb': 2500000,
+    }
+
+
+def create_pipeline_request(r_id: int = 1) -> Dict:
+    return {
+        'id': r_id,
+        'method': 'create',
+        'params': {'type': 'MediaPipeline', 'constructorParams': {}, 'properties': {}},
+        'jsonrpc': '2.0',
+    }
+
+
+def create_endpoint_reply(r_id: int = 2) -> Dict:
+    return {'id': r_id, 'result': {'value': ENDPOINT_ID, 'sessionId': SESSION_ID}, 'jsonrpc': '2.0'}
+
+
+def process_offer_request(r_id: int = 3) -> Dict:
+    return {
+        'id': r_id,
+        'method': 'invoke',
+        'params': {
+            'object': ENDPOINT_ID,
+            'operation': 'processOffer',
+            'operationParams': {'offer': _sdp()},
+            'sessionId': SESSION_ID,
+        },
+        'jsonrpc': '2.0',
+    }
+
+
+def generate_offer_reply(r_id: int = 4) -> Dict:
+    return {'id': r_id, 'result': {'value': _sdp(), 'sessionId': SESSION_ID}, 'jsonrpc': '2.0'}
+
+
+def ice_candidate_event(i: int = 0) -> Dict:
+    return {
+        'jsonrpc': '2.0',
+        'method': 'onEvent',
+        'params': {
+            'value': {
+                'data': {
+                    'candidate': {
+                        'candidate': f'candidate:{i} 1 UDP 2015363327 172.17.0.{2 + i % 200} {40000 + i} typ host',
+                        'sdpMid': 'video0',
+                        'sdpMLineIndex': 1,
+                        '__module__': 'kurento',
+                        '__type__': 'IceCandidate',
+                    },
+                    'componentId': 1,
+                    'streamId': 1,
+                    'source': ENDPOINT_ID,
+                    'tags': [],
+                    'timestamp': '1597305600',
+                    'timestampMillis': '1597305600123',
+                    'type': 'IceCandidateFound',
+                },
+                'object': ENDPOINT_ID,
+                'type': 'IceCandidateFound',
+            }
+        },
+    }
+
+
+def get_stats_reply(r_id: int = 5, streams: int = 24) -> Dict:
+    return {
+        'id': r_id,
+        'result': {'value': {entry['id']: entry for entry in map(_stats_entry, range(streams))},
+                   'sessionId': SESSION_ID},
+        'jsonrpc': '2.0',
+    }
+
+
+SHAPES = {
+    'create_pipeline': create_pipeline_request,
+    'create_endpoint_reply': create_endpoint_reply,
+    'ice_candidate_event': ice_candidate_event,
+    'process_offer': process_offer_request,
+    'generate_offer_reply': generate_offer_reply,
+    'get_stats_reply': get_stats_reply,
+}
+
+
+def synthetic_kurento_set() -> List[Dict]:
+    # Message mix of a single participant joining a room, built from the shapes above
+    messages = [create_pipeline_request(1), create_endpoint_reply(2), process_offer_request(3),
+                generate_offer_reply(4)]
+    messages.extend(ice_candidate_event(i) for i in range(12))
+    messages.append(get_stats_reply(5))
+    return copy.deepcopy(messages)
+
+
+def _participant(i: int) -> Dict:
+    return {'id': f'{i:032x}', 'name': f'participant {i}', 'publishing': i % 2 == 0}
+
+
+def synthetic_browser_set(participants: int = 8) -> List[Dict]:
+    # What a browser sends and receives on /ws while joining a room and publishing, made up like the above
+    me = _participant(participants)
+    messages = [
+        {'type': 'join', 'room': 'standup', 'name': me['name']},
+        {'type': 'joined', 'room': 'standup', 'participant': me['id'],
+         'participants': [_participant(i) for i in range(participants + 1)]},
+        {'type': 'offer', 'sdp': _sdp()},
+        {'type': 'answer', 'sdp': _sdp()},
+    ]
+    for i in range(4):
+        candidates = [{'candidate': f'candidate:{j} 1 UDP 2015363327 172.17.0.{2 + j} {40000 + j} typ host',
+                       'sdpMid': 'video0', 'sdpMLineIndex': 1} for j in range(i * 3, i * 3 + 3)]
+        messages.append({'type': 'iceCandidate', 'candidate': candidates[0]})
+        messages.append({'type': 'iceCandidates', 'endpoint': ENDPOINT_ID, 'candidates': candidates,
+                         'done': i == 3})
+    messages.extend({'type': 'newPublisher', 'participant': _participant(i)} for i in range(0, participants, 2))
+    messages.append({'type': 'chat', 'from': me['id'], 'text': 'hi all'})
+    return copy.deepcopy(messages)
+
+
+def captured_sets(path: str) -> Dict[str, List[Any]]:
+    """Every frame of a recording made with ``rs --record``, decoded, by peer ('kurento' or 'browser')."""
+    sets: Dict[str, List[Any]] = {}
+    connections = {}
+    for record in read_records(path):
+        if record.kind == Kind.START:
+            # Connection ids start again with every run
+            connections = {}
+        elif record.kind == Kind.OPEN:
+            info = record.info()
+            codec = codecs[info['codec']]() if info['codec'] in codecs else get_codec()
+            connections[record.connection] = sets.setdefault(info['peer'], []), codec
+        elif record.kind in (Kind.IN, Kind.OUT) and record.connection in connections:
+            messages, codec = connections[record.connection]
+            messages.append(codec.loads(record.payload))
+    return sets
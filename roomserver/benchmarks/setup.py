@@ -0,0 +1,81 @@
+import argparse
+import asyncio
+import logging
+import time
+
+from roomserver.kms_emulator import running_emulator
+from roomserver.media.pipeline import MediaPipeline
+from roomserver.media.plan import SetupPlan
+from roomserver.media.pool import KurentoPool
+from roomserver.media.session import KurentoSession
+from roomserver.media.web_rtc_endpoint import WebRTCEndPoint
+
+EVENTS = ('IceCandidateFound', 'IceGatheringDone')
+
+
+async def noop(data):
+    pass
+
+
+async def sequential(session: KurentoSession, participants: int) -> MediaPipeline:
+    pipeline = MediaPipeline(session)
+    await pipeline.create()
+    endpoints = []
+    for _ in range(participants):
+        endpoint = WebRTCEndPoint(pipeline, session)
+        await endpoint.create()
+        for event_type in EVENTS:
+            await endpoint.subscribe(event_type, noop)
+        endpoints.append(endpoint)
+    for source in endpoints:
+        for sink in endpoints:
+            if source is not sink:
+                await source.connect(sink)
+    return pipeline
+
+
+async def planned(session: KurentoSession, participants: int) -> MediaPipeline:
+    plan = SetupPlan()
+    plan.pipeline('pipeline', session)
+    endpoints = [plan.endpoint(f'endpoint {i}', 'pipeline', session) for i in range(participants)]
+    for endpoint in endpoints:
+        for event_type in EVENTS:
+            plan.add(f'{endpoint} {event_type}', lambda results, e=endpoint, t=event_type: results[e].subscribe(t, noop),
+                     after=[endpoint])
+    for source in endpoints:
+        for sink in endpoints:
+            if source != sink:
+                plan.connect(f'{source} -> {sink}', source, sink)
+    return (await plan.run())['pipeline']
+
+
+async def run(args):
+    async with running_emulator(latency=args.latency, jitter=args.jitter, seed=1) as (emulator, url):
+        async with KurentoPool(url, size=1) as pool:
+            session = pool.session()
+            rounds = args.participants * (1 + len(EVENTS)) + 1 + args.participants * (args.participants - 1)
+            print(f'{args.participants} participants, {rounds} calls per room, latency {args.latency}s'
+                  f' (critical path 3 round trips = {3 * args.latency * 1e3:.0f} ms)')
+            for name, setup in (('sequential', sequential), ('plan', planned)):
+                elapsed = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    pipeline = await setup(session, args.participants)
+                    elapsed.append(time.perf_counter() - start)
+                    await pipeline.release()
+                print(f'{name:10} {min(elapsed) * 1e3:9.1f} ms best  {sum(elapsed) / len(elapsed) * 1e3:9.1f} ms mean')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Room setup: sequential calls vs a SetupPlan')
+    parser.add_argument('-k', '--participants', type=int, default=6)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
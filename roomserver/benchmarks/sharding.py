@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import logging
+import socket
+import sys
+import time
+from contextlib import asynccontextmanager
+
+from roomserver.media.placement import Placement
+from roomserver.media.web_rtc_endpoint import WebRTCEndPoint
+
+logger = logging.getLogger('sharding')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+@asynccontextmanager
+async def fake_servers(count: int, *args: str):
+    """Runs ``count`` emulated KMS processes and yields their URLs."""
+    ports = [free_port() for _ in range(count)]
+    processes = [await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'roomserver.kms_emulator', '--port', str(port), *args) for port in ports]
+    try:
+        await asyncio.gather(*(wait_port(port) for port in ports))
+        yield [f'ws://127.0.0.1:{port}/kurento' for port in ports]
+    finally:
+        for process in processes:
+            process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes))
+
+
+async def join_room(placement: Placement, room_id: str, participants: int):
+    pipeline = await placement.create_pipeline(room_id)
+    endpoints = [WebRTCEndPoint(pipeline, pipeline.session) for _ in range(participants)]
+    await asyncio.gather(*(endpoint.create() for endpoint in endpoints))
+
+
+async def run(servers: int, rooms: int, participants: int, kill: bool):
+    async with fake_servers(servers) as urls:
+        async with Placement(urls, cpu_interval=0.5) as placement:
+            await asyncio.sleep(0.2)
+            start = time.perf_counter()
+            await asyncio.gather(*(join_room(placement, f'room-{i}', participants) for i in range(rooms)))
+            elapsed = time.perf_counter() - start
+            print(f'{rooms} rooms x {participants} participants on {servers} servers in {elapsed:.3f}s')
+            for stats in placement.stats:
+                print(stats)
+
+            rooms_on = {room: server.url for room, server in placement.rooms.items()}
+            assert len(placement.rooms) == rooms, 'every room must be placed exactly once'
+            assert all(server.url == rooms_on[room] for room, server in placement.rooms.items())
+
+            if kill:
+                # Rooms placed afterwards must avoid a server whose links are down
+                victim = placement.servers[0]
+                for link in victim.pool.links:
+                    link.task.cancel()
+                await asyncio.sleep(0.1)
+                await join_room(placement, 'late-room', participants)
+                assert placement.rooms['late-room'] is not victim
+                print('late-room placed on', placement.rooms['late-room'].url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Place rooms over several emulated Kurento servers')
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--rooms', type=int, default=30)
+    parser.add_argument('--participants', type=int, default=4)
+    parser.add_argument('--kill', action='store_true', help='take one server down and place one more room')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args.servers, args.rooms, args.participants, args.kill))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+from typing import Any, Union, Optional, Dict, Callable
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+Payload = Union[str, bytes]
+
+# SDP offers/answers are ~3-6 KiB, getStats replies easily reach tens of KiB
+DEFAULT_OFFLOAD_THRESHOLD = 16 * 1024
+
+
+class JsonCodec:
+    name = 'json'
+    # Payloads of binary codecs go out as binary frames
+    binary = False
+
+    def dumps(self, data: Any) -> Payload:
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
+    def loads(self, data: Payload) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, data: Any) -> Payload:
+        return orjson.dumps(data)
+
+    def loads(self, data: Payload) -> Any:
+        return orjson.loads(data)
+
+
+class UjsonCodec(JsonCodec):
+    name = 'ujson'
+
+    def dumps(self, data: Any) -> Payload:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+
+    def loads(self, data: Payload) -> Any:
+        return ujson.loads(data)
+
+
+class MsgpackCodec(JsonCodec):
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, data: Any) -> Payload:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, data: Payload) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+codecs: Dict[str, Callable[[], JsonCodec]] = {'json': JsonCodec}
+if ujson is not None:
+    codecs['ujson'] = UjsonCodec
+if orjson is not None:
+    codecs['orjson'] = OrjsonCodec
+if msgpack is not None:
+    codecs['msgpack'] = MsgpackCodec
+
+# Codec for every /ws subprotocol, None is the default JSON codec; without a subprotocol
+# the browser gets JSON text frames as well
+SUBPROTOCOLS: Dict[str, Optional[str]] = {}
+if msgpack is not None:
+    SUBPROTOCOLS['roomserver.msgpack'] = 'msgpack'
+SUBPROTOCOLS['roomserver.json'] = None
+
+
+def get_codec(name: Optional[str] = None) -> JsonCodec:
+    if name is None:
+        for name in ('orjson', 'ujson', 'json'):
+            if name in codecs:
+                break
+    return codecs[name]()
+
+
+def estimate_size(data: Any, limit: int) -> int:
+    # Cheap upper-bound guess that stops as soon as ``limit`` is reached
+    size = 0
+    stack = [data]
+    while stack and size < limit:
+        item = stack.pop()
+        if isinstance(item, str):
+            size += len(item) + 2
+        elif isinstance(item, dict):
+            size += 2
+            for key, value in item.items():
+                size += len(key) + 4
+                stack.append(value)
+        elif isinstance(item, (list, tuple)):
+            size += 2
+            stack.extend(item)
+        else:
+            size += 8
+    return size
+
+
+class FrameCodec:
+    """Encodes/decodes frames for a socket, moving big payloads off the loop."""
+
+    def __init__(self, codec: Optional[JsonCodec] = None, offload_threshold: Optional[int] = DEFAULT_OFFLOAD_THRESHOLD):
+        self.codec = codec or get_codec()
+        self.offload_threshold = offload_threshold
+
+    @property
+    def name(self) -> str:
+        return self.codec.name
+
+    @property
+    def binary(self) -> bool:
+        return self.codec.binary
+
+    def _is_large(self, size: int) -> bool:
+        return self.offload_threshold is not None and size >= self.offload_threshold
+
+    async def encode(self, data: Any) -> Payload:
+        if self._is_large(estimate_size(data, self.offload_threshold or 0)):
+            return await asyncio.get_running_loop().run_in_executor(None, self.codec.dumps, data)
+        return self.codec.dumps(data)
+
+    async def decode(self, data: Payload) -> Any:
+        if self._is_large(len(data)):
+            return await asyncio.get_running_loop().run_in_executor(None, self.codec.loads, data)
+        return self.codec.loads(data)
+
+
+def subprotocol_codec(subprotocol: Optional[str]) -> FrameCodec:
+    return FrameCodec(get_codec(SUBPROTOCOLS.get(subprotocol)))
@@ -0,0 +1,128 @@
+import asyncio
+import enum
+import logging
+from typing import Any, Optional, Callable, Iterable
+
+from .codec import estimate_size
+from .metrics import TimedQueue
+
+logger = logging.getLogger(__name__)
+
+DROPPABLE_TYPES = frozenset({'stats', 'presence', 'speaking'})
+
+
+class SlowConsumerPolicy(enum.Enum):
+    BLOCK = 'block'
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
+
+class SlowConsumer(Exception):
+    def __init__(self, depth: int, size: int):
+        self.depth = depth
+        self.size = size
+
+    def __str__(self):
+        return f'SlowConsumer: {self.depth} messages / {self.size} bytes queued'
+
+
+def is_droppable_type(item: Any, types: Iterable[str] = DROPPABLE_TYPES) -> bool:
+    return isinstance(item, dict) and item.get('type') in types
+
+
+def payload_size(item: Any) -> int:
+    if item is None:
+        return 0
+    if isinstance(item, (str, bytes)):
+        return len(item)
+    return estimate_size(item, 1 << 20)
+
+
+class FlowControl:
+    """Watermarks and slow consumer policy of an outbound queue.
+
+    The producer is paused once either ``high_watermark`` messages or ``high_bytes``
+    are queued and resumed when both fall below the low marks. With DROP policy
+    droppable messages are discarded while paused and other messages are still
+    queued up to ``max_size``/``max_bytes``, past which the peer is disconnected.
+    """
+
+    def __init__(self, policy: SlowConsumerPolicy = SlowConsumerPolicy.BLOCK,
+                 high_watermark: int = 256, low_watermark: int = 64,
+                 high_bytes: int = 1 << 20, low_bytes: int = 256 << 10,
+                 max_size: Optional[int] = None, max_bytes: Optional[int] = None,
+                 is_droppable: Callable[[Any], bool] = is_droppable_type):
+        assert low_watermark <= high_watermark and low_bytes <= high_bytes
+        self.policy = policy
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.high_bytes = high_bytes
+        self.low_bytes = low_bytes
+        self.max_size = max_size or high_watermark * 4
+        self.max_bytes = max_bytes or high_bytes * 4
+        self.is_droppable = is_droppable
+
+
+class FlowControlQueue(TimedQueue):
+    def __init__(self, flow: Optional[FlowControl] = None, wait=None):
+        super().__init__(wait=wait)
+        self.flow = flow or FlowControl()
+        self.bytes = 0
+        self.dropped = 0
+        self.paused = False
+        self._resumed = asyncio.Event()
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._sizes = type(self._queue)()
+
+    def _put(self, item):
+        size = payload_size(item)
+        super()._put(item)
+        self._sizes.append(size)
+        self._grew(size)
+
+    def _get(self):
+        size = self._sizes.popleft()
+        item = super()._get()
+        self._shrank(size)
+        return item
+
+    def _grew(self, size: int):
+        self.bytes += size
+        if self.qsize() >= self.flow.high_watermark or self.bytes >= self.flow.high_bytes:
+            if not self.paused:
+                logger.debug('Pausing producer: %s messages / %s bytes', self.qsize(), self.bytes)
+            self.paused = True
+            self._resumed.clear()
+
+    def _shrank(self, size: int):
+        self.bytes -= size
+        if self.paused and self.qsize() <= self.flow.low_watermark and self.bytes <= self.flow.low_bytes:
+            self.paused = False
+            self._resumed.set()
+
+    async def put(self, item, droppable: Optional[bool] = None) -> bool:
+        if not await self._admit(item, droppable):
+            return False
+        self.put_nowait(item)
+        return True
+
+    async def _admit(self, item, droppable: Optional[bool]) -> bool:
+        """Apply the slow consumer policy; False if ``item`` is dropped."""
+        flow = self.flow
+        if self.paused:
+            if flow.policy == SlowConsumerPolicy.DISCONNECT:
+                raise SlowConsumer(self.qsize(), self.bytes)
+            if flow.policy == SlowConsumerPolicy.DROP:
+                if droppable is None:
+                    droppable = flow.is_droppable(item)
+                if droppable:
+                    self.dropped += 1
+                    return False
+                if self.qsize() >= flow.max_size or self.bytes >= flow.max_bytes:
+                    raise SlowConsumer(self.qsize(), self.bytes)
+            else:
+                while self.paused:
+                    await self._resumed.wait()
+        return True
@@ -3,10 +3,12 @@ import logging
 from pprint import pprint
 from typing import Dict, Awaitable
 
+from .media.pending import PendingRequests
 from .protocol import ReaderWriterBase
 
 logger = logging.getLogger(__name__)
-requests: Dict[int, asyncio.Future] = {}
+# Same deadlines and bound as JsonRPCBase; unanswered requests fail with JSONRpcTimeout
+requests = PendingRequests()
 
 
 class JSONRpcException(Exception):
@@ -39,11 +41,11 @@ class JsonRPC(ReaderWriterBase):
                     pprint(item)
                 return
 
-            if r_id not in requests:
+            future = requests.pop(r_id)
+            if future is None:
                 logger.error("Unknown response: %s", str(item))
                 return
 
-            future = requests[r_id]
             if 'error' in item:
                 future.set_exception(JSONRpcException(item['error']['code'], item['error']['message']))
             elif 'result' in item:
@@ -74,9 +76,9 @@ def json_request(method: str, params: Dict):
 
 def json_rpc_custom_request(out_q: asyncio.Queue, method: str, params: Dict) -> Awaitable:
     request = json_request(method, params)
-    requests[request['id']] = asyncio.Future()
+    future = requests.add(request['id'], method, request=request)
     out_q.put_nowait(request)
-    return requests[request['id']]
+    return future
 
 
 
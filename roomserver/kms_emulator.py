@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Any, List, Tuple, Set
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SERVER_MANAGER = 'manager_ServerManager'
+
+
+class KurentoError(Exception):
+    def __init__(self, code: int, msg: str):
+        self.code = code
+        self.msg = msg
+
+
+SDP = '\r\n'.join([
+    'v=0',
+    'o=- 3794384120 3794384120 IN IP4 0.0.0.0',
+    's=Kurento Media Server',
+    'c=IN IP4 0.0.0.0',
+    't=0 0',
+    'm=audio 9 UDP/TLS/RTP/SAVPF 111',
+    'a=rtpmap:111 opus/48000/2',
+    'm=video 9 UDP/TLS/RTP/SAVPF 96',
+    'a=rtpmap:96 VP8/90000',
+]) + '\r\n'
+
+
+class EmulatedObject:
+    def __init__(self, object_id: str, type_: str, pipeline: Optional[str] = None):
+        self.object_id = object_id
+        self.type = type_
+        self.pipeline = pipeline
+        self.sinks: List[str] = []
+        self.media_state = 'DISCONNECTED'
+        self.tags: Dict[str, str] = {}
+        self.created = time.monotonic()
+
+    def stats(self) -> Dict[str, Dict]:
+        # Counters of one inbound and one outbound video stream at 1 Mbit/s since creation
+        elapsed = time.monotonic() - self.created
+        packets = int(elapsed * 100)
+        return {
+            'inbound_video': {'id': 'inbound_video', 'type': 'inboundrtp', 'timestamp': time.time(),
+                              'packetsReceived': packets, 'bytesReceived': packets * 1250,
+                              'packetsLost': packets // 1000, 'jitter': 0.004, 'fractionLost': 0.0},
+            'outbound_video': {'id': 'outbound_video', 'type': 'outboundrtp', 'timestamp': time.time(),
+                               'packetsSent': packets, 'bytesSent': packets * 1250, 'roundTripTime': 0.02,
+                               'targetBitrate': 1000000},
+        }
+
+
+class EmulatedConnection:
+    def __init__(self, ws: web.WebSocketResponse):
+        self.ws = ws
+        self.session_id = str(uuid.uuid4())
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def send(self, data: Any):
+        if not self.ws.closed:
+            await self.ws.send_str(json.dumps(data))
+
+
+class KurentoEmulator:
+    """Fake Kurento JSON-RPC server keeping just enough object state for the roomserver.
+
+    ``latency`` +/- ``jitter`` seconds are spent on every request, which lets
+    replies overtake each other, and ``error_rate`` of them fail.
+    """
+
+    def __init__(self, cpu_per_pipeline: float = 2.0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, candidates: int = 4, seed: Optional[int] = None):
+        self.cpu_per_pipeline = cpu_per_pipeline
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.candidates = candidates
+        self.random = random.Random(seed)
+        self.objects: Dict[str, EmulatedObject] = {}
+        # Subscriptions belong to sessions; events go to the connection the session last used
+        self.subscriptions: Dict[str, Tuple[str, str, str]] = {}
+        self.connections: Dict[str, EmulatedConnection] = {}
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def pipelines(self) -> List[str]:
+        return [o.object_id for o in self.objects.values() if o.type == 'MediaPipeline']
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.get('/kurento', self.websocket_handler)])
+        return app
+
+    async def websocket_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        conn = EmulatedConnection(ws)
+        try:
+            async for msg in ws:
+                task = asyncio.create_task(self.dispatch(json.loads(msg.data), conn))
+                conn.tasks.add(task)
+                task.add_done_callback(conn.tasks.discard)
+        finally:
+            for task in conn.tasks:
+                task.cancel()
+            for session_id in [k for k, v in self.connections.items() if v is conn]:
+                del self.connections[session_id]
+        return ws
+
+    async def dispatch(self, data: Any, conn: EmulatedConnection):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if isinstance(data, list):
+            replies = [await self.handle(item, conn) for item in data]
+            await conn.send([r for r in replies if r is not None])
+        else:
+            reply = await self.handle(data, conn)
+            if reply is not None:
+                await conn.send(reply)
+
+    async def handle(self, item: Dict, conn: EmulatedConnection) -> Optional[Dict]:
+        self.requests += 1
+        r_id = item.get('id')
+        params = item.get('params') or {}
+        session_id = params.get('sessionId', conn.session_id)
+        self.connections[session_id] = conn
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                raise KurentoError(-32000, 'Emulated failure')
+            handler = getattr(self, 'on_' + item.get('method', ''), None)
+            if handler is None:
+                raise KurentoError(-32601, 'Method not found')
+            value = handler(params, session_id)
+        except KurentoError as e:
+            self.errors += 1
+            return {'jsonrpc': '2.0', 'id': r_id, 'error': {'code': e.code, 'message': e.msg}}
+        if r_id is None:
+            return None
+        result = {'sessionId': session_id}
+        if value is not None:
+            result['value'] = value
+        return {'jsonrpc': '2.0', 'id': r_id, 'result': result}
+
+    def _object(self, object_id: str) -> EmulatedObject:
+        if object_id not in self.objects:
+            raise KurentoError(40101, f'Object {object_id} not found')
+        return self.objects[object_id]
+
+    def emit(self, object_id: str, type_: str, data: Optional[Dict] = None):
+        data = dict(data or {}, source=object_id, type=type_, tags=[])
+        event = {
+            'jsonrpc': '2.0',
+            'method': 'onEvent',
+            'params': {'value': {'data': data, 'object': object_id, 'type': type_}},
+        }
+        for sub_object, sub_type, session_id in list(self.subscriptions.values()):
+            conn = self.connections.get(session_id)
+            if conn is not None and sub_object == object_id and sub_type == type_:
+                task = asyncio.create_task(conn.send(event))
+                conn.tasks.add(task)
+                task.add_done_callback(conn.tasks.discard)
+
+    def on_ping(self, params: Dict, session_id: str) -> Any:
+        return 'pong'
+
+    def on_connect(self, params: Dict, session_id: str) -> Any:
+        return None
+
+    def on_subscribe(self, params: Dict, session_id: str) -> Any:
+        obj = self._object(params['object'])
+        sub_id = str(uuid.uuid4())
+        self.subscriptions[sub_id] = (obj.object_id, params['type'], session_id)
+        return sub_id
+
+    def on_unsubscribe(self, params: Dict, session_id: str) -> Any:
+        if self.subscriptions.pop(params.get('subscription'), None) is None:
+            raise KurentoError(40101, f'Subscription {params.get("subscription")} not found')
+        return None
+
+    def on_create(self, params: Dict, session_id: str) -> Any:
+        type_ = params['type']
+        suffix = f'{uuid.uuid4()}_kurento.{type_}'
+        if type_ == 'MediaPipeline':
+            obj = EmulatedObject(suffix, type_)
+        else:
+            pipeline = self._object(params.get('constructorParams', {}).get('mediaPipeline'))
+            obj = EmulatedObject(f'{pipeline.object_id}/{suffix}', type_, pipeline.object_id)
+        self.objects[obj.object_id] = obj
+        return obj.object_id
+
+    def on_release(self, params: Dict, session_id: str) -> Any:
+        obj = self._object(params['object'])
+        released = {obj.object_id}
+        if obj.type == 'MediaPipeline':
+            released.update(o.object_id for o in self.objects.values() if o.pipeline == obj.object_id)
+        for object_id in released:
+            del self.objects[object_id]
+        for sub_id in [k for k, v in self.subscriptions.items() if v[0] in released]:
+            del self.subscriptions[sub_id]
+        return None
+
+    def on_invoke(self, params: Dict, session_id: str) -> Any:
+        operation = params['operation']
+        operation_params = params.get('operationParams') or {}
+        if params['object'] == SERVER_MANAGER:
+            if operation == 'getUsedCpu':
+                return min(100.0, len(self.pipelines) * self.cpu_per_pipeline)
+            if operation == 'getPipelines':
+                return self.pipelines
+            if operation == 'getUsedMemory':
+                return 1024 * len(self.objects)
+            raise KurentoError(40104, f'Unknown operation {operation}')
+        obj = self._object(params['object'])
+        if operation == 'connect':
+            obj.sinks.append(self._object(operation_params['sink']).object_id)
+            return None
+        if operation == 'getChildren':
+            return [o.object_id for o in self.objects.values() if o.pipeline == obj.object_id]
+        if operation in ('generateOffer', 'processOffer', 'processAnswer'):
+            if operation != 'generateOffer' and obj.media_state != 'CONNECTED':
+                obj.media_state = 'CONNECTED'
+                self.emit(obj.object_id, 'MediaStateChanged', {'oldState': 'DISCONNECTED', 'newState': 'CONNECTED'})
+            return SDP
+        if operation == 'addTag':
+            obj.tags[operation_params['key']] = operation_params['value']
+            return None
+        if operation == 'getTags':
+            return [{'key': key, 'value': value} for key, value in obj.tags.items()]
+        if operation == 'getMediaState':
+            return obj.media_state
+        if operation == 'getName':
+            return obj.object_id
+        if operation == 'getStats':
+            return obj.stats()
+        if operation == 'gatherCandidates':
+            for i in range(self.candidates):
+                self.emit(obj.object_id, 'IceCandidateFound', {'candidate': {
+                    'candidate': f'candidate:{i} 1 UDP 2015363327 127.0.0.1 {40000 + i} typ host',
+                    'sdpMid': 'video0',
+                    'sdpMLineIndex': 1,
+                    '__module__': 'kurento',
+                    '__type__': 'IceCandidate',
+                }})
+            self.emit(obj.object_id, 'IceGatheringDone')
+            return None
+        return None
+
+
+@asynccontextmanager
+async def running_emulator(host: str = '127.0.0.1', port: int = 0, **kwargs):
+    """Serves a KurentoEmulator on the current loop and yields it with its URL."""
+    emulator = KurentoEmulator(**kwargs)
+    runner = web.AppRunner(emulator.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        yield emulator, f'ws://{host}:{port}/kurento'
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Kurento Media Server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds spent on every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests that fail')
+    args = parser.parse_args()
+    emulator = KurentoEmulator(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    web.run_app(emulator.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
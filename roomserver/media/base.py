@@ -1,6 +1,58 @@
+import logging
+from typing import Any, Optional, List
+
+from roomserver.scheduling import Priority
+
+from .events import Subscription, EventCallback
 from .session import KurentoSession
 
+logger = logging.getLogger(__name__)
+
 
 class MediaBase:
     def __init__(self, session: KurentoSession):
         self.session = session
+        self.subscriptions: List[Subscription] = []
+
+    @property
+    def object_id(self) -> Optional[str]:
+        raise NotImplementedError
+
+    async def subscribe(self, event_type: str, callback: EventCallback) -> Subscription:
+        subscription = await self.session.subscribe(self.object_id, event_type, callback)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription, callback: Optional[EventCallback] = None):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+        await self.session.unsubscribe(subscription, callback)
+
+    async def get_property(self, operation: str) -> Any:
+        """Value of a getter such as 'getMediaState', served from the session's cache."""
+        return await self.session.properties.get(self.object_id, operation)
+
+    def _drop_subscriptions(self):
+        # Kurento drops the subscriptions of a released object by itself
+        self.session.events.drop_object(self.object_id)
+        self.session.properties.drop_object(self.object_id)
+        self.subscriptions.clear()
+
+    def forget(self):
+        """Drop local state of an object that is (being) released on Kurento."""
+        self._drop_subscriptions()
+
+    async def release(self):
+        object_id = self.object_id
+        if object_id is None:
+            return
+        self.forget()
+        try:
+            a_response = await self.session.send_request(method="release", params={
+                "object": object_id
+            }, priority=Priority.INTERACTIVE)
+            await a_response
+        except Exception:
+            logger.exception('COMMAND: ')
+        else:
+            logger.info("Released: %s", object_id)
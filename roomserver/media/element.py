@@ -1,9 +1,12 @@
+import logging
 from typing import Optional
 
 from .base import MediaBase
 from .pipeline import MediaPipeline
 from .session import KurentoSession
 
+logger = logging.getLogger(__name__)
+
 
 class MediaElement(MediaBase):
     element_id: Optional[str] = None
@@ -11,3 +14,30 @@ class MediaElement(MediaBase):
     def __init__(self, pipeline: MediaPipeline, session: KurentoSession):
         super().__init__(session)
         self.pipeline = pipeline
+
+    @property
+    def object_id(self) -> Optional[str]:
+        if self.element_id is None:
+            return None
+        return f'{self.pipeline.pipeline_id}/{self.element_id}'
+
+    async def connect(self, sink: 'MediaElement') -> bool:
+        try:
+            a_response = await self.session.send_request(method="invoke", params={
+                "object": self.object_id,
+                "operation": "connect",
+                "operationParams": {
+                    "sink": sink.object_id
+                },
+            })
+            await a_response
+        except Exception:
+            logger.exception('COMMAND: ')
+            return False
+        else:
+            logger.info("Connected %s -> %s", self.element_id, sink.element_id)
+            return True
+
+    def forget(self):
+        super().forget()
+        self.element_id = None
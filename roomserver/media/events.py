@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Dict, Tuple, Callable, Awaitable, Optional, Set, List
+
+logger = logging.getLogger(__name__)
+
+EventCallback = Callable[[Dict], Awaitable]
+
+
+class Subscription:
+    __slots__ = ('object_id', 'event_type', 'subscription_id', 'callbacks', 'ready')
+
+    def __init__(self, object_id: str, event_type: str):
+        self.object_id = object_id
+        self.event_type = event_type
+        self.subscription_id: Optional[str] = None
+        self.callbacks: List[EventCallback] = []
+        self.ready = asyncio.get_event_loop().create_future()
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.object_id, self.event_type
+
+
+class EventRegistry:
+    """Kurento subscriptions indexed by (object id, event type).
+
+    Several callbacks on the same key share one Kurento subscription. Events are
+    routed with a single dict lookup; the per-object index is only used when an
+    object is released.
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[Tuple[str, str], Subscription] = {}
+        self._by_object: Dict[str, Set[str]] = {}
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def get(self, object_id: str, event_type: str) -> Optional[Subscription]:
+        return self._subscriptions.get((object_id, event_type))
+
+    def add(self, object_id: str, event_type: str) -> Subscription:
+        subscription = Subscription(object_id, event_type)
+        self._subscriptions[subscription.key] = subscription
+        self._by_object.setdefault(object_id, set()).add(event_type)
+        return subscription
+
+    def remove(self, subscription: Subscription):
+        if self._subscriptions.get(subscription.key) is not subscription:
+            return
+        del self._subscriptions[subscription.key]
+        types = self._by_object[subscription.object_id]
+        types.discard(subscription.event_type)
+        if not types:
+            del self._by_object[subscription.object_id]
+
+    def drop_object(self, object_id: str, children: bool = False) -> List[Subscription]:
+        object_ids = [object_id]
+        if children:
+            prefix = object_id + '/'
+            object_ids.extend(o for o in self._by_object if o.startswith(prefix))
+        dropped = []
+        for o_id in object_ids:
+            for event_type in self._by_object.pop(o_id, ()):
+                dropped.append(self._subscriptions.pop((o_id, event_type)))
+        return dropped
+
+    def subscriptions(self) -> List[Subscription]:
+        return list(self._subscriptions.values())
+
+    async def dispatch(self, object_id: str, event_type: str, data: Dict) -> bool:
+        subscription = self._subscriptions.get((object_id, event_type))
+        if subscription is None:
+            return False
+        for callback in list(subscription.callbacks):
+            try:
+                await callback(data)
+            except Exception:
+                logger.exception('Event callback failed: %s %s', object_id, event_type)
+        return True
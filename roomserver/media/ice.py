@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import Callable, Awaitable, List, Any, Optional, Dict, Set
+
+from .events import Subscription
+from .web_rtc_endpoint import WebRTCEndPoint
+
+logger = logging.getLogger(__name__)
+
+END_OF_CANDIDATES = object()
+
+
+def to_browser(candidate: Dict) -> Dict:
+    return {
+        'candidate': candidate['candidate'],
+        'sdpMid': candidate.get('sdpMid'),
+        'sdpMLineIndex': candidate.get('sdpMLineIndex'),
+    }
+
+
+def to_kurento(candidate: Dict) -> Dict:
+    return {
+        'candidate': candidate['candidate'],
+        'sdpMid': candidate.get('sdpMid'),
+        'sdpMLineIndex': candidate.get('sdpMLineIndex'),
+        '__module__': 'kurento',
+        '__type__': 'IceCandidate',
+    }
+
+
+class Coalescer:
+    """Collects items and hands them to ``flush`` in batches.
+
+    A batch goes out ``window`` seconds after its first item or as soon as it
+    holds ``max_count`` items, whichever comes first. Batches are flushed one at
+    a time in the order they were closed.
+    """
+
+    def __init__(self, flush: Callable[[List[Any]], Awaitable], window: float = 0.02, max_count: int = 16):
+        self.flush = flush
+        self.window = window
+        self.max_count = max_count
+        self._items: List[Any] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add(self, item: Any):
+        self._items.append(item)
+        if len(self._items) >= self.max_count:
+            self.flush_now()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, self.flush_now)
+
+    def flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        if not items:
+            return
+        task = asyncio.create_task(self._flush(items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, items: List[Any]):
+        async with self._lock:
+            try:
+                await self.flush(items)
+            except Exception:
+                logger.exception('Flush of %s items failed', len(items))
+
+    async def close(self):
+        self.flush_now()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+
+class IceRelay:
+    """Trickle ICE between one WebRtcEndpoint and its browser.
+
+    Kurento candidates are forwarded as one ``iceCandidates`` message per batch
+    and IceGatheringDone flushes the batch with ``done`` set. Browser candidates
+    are sent to Kurento as batched addIceCandidate calls; a ``None`` candidate
+    (end of candidates) just flushes what is pending.
+    """
+
+    def __init__(self, endpoint: WebRTCEndPoint, send: Callable[[Dict], Awaitable],
+                 window: float = 0.02, max_count: int = 16):
+        self.endpoint = endpoint
+        self.send = send
+        self.local = Coalescer(self._send_local, window, max_count)
+        self.remote = Coalescer(self.endpoint.add_ice_candidates, window, max_count)
+        self.gathering_done = False
+        self._subscriptions: List[Subscription] = []
+
+    async def start(self):
+        self._subscriptions = list(await asyncio.gather(
+            self.endpoint.subscribe('IceCandidateFound', self.on_candidate_found),
+            self.endpoint.subscribe('IceGatheringDone', self.on_gathering_done),
+        ))
+
+    async def close(self):
+        await asyncio.gather(self.local.close(), self.remote.close())
+        for subscription, callback in zip(self._subscriptions, (self.on_candidate_found, self.on_gathering_done)):
+            await self.endpoint.unsubscribe(subscription, callback)
+        self._subscriptions = []
+
+    async def on_candidate_found(self, data: Dict):
+        self.local.add(to_browser(data['candidate']))
+
+    async def on_gathering_done(self, data: Dict):
+        self.gathering_done = True
+        # The marker closes the current batch so it is sent with ``done`` set
+        self.local.add(END_OF_CANDIDATES)
+        self.local.flush_now()
+
+    async def _send_local(self, items: List[Any]):
+        done = items[-1] is END_OF_CANDIDATES
+        await self.send({
+            'type': 'iceCandidates',
+            'endpoint': self.endpoint.element_id,
+            'candidates': items[:-1] if done else items,
+            'done': done,
+        })
+
+    def add_remote_candidate(self, candidate: Optional[Dict]):
+        if candidate is None or not candidate.get('candidate'):
+            self.remote.flush_now()
+            return
+        self.remote.add(to_kurento(candidate))
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import socket
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+from roomserver.scheduling import Priority
+
+from .base import MediaBase
+from .element import MediaElement
+from .ice import Coalescer
+from .pipeline import MediaPipeline
+from .placement import SERVER_MANAGER
+from .session import KurentoSession
+
+logger = logging.getLogger(__name__)
+
+# Pipelines created here carry this tag, so the sweeper leaves other applications' pipelines alone
+OWNER_TAG = 'roomserver.owner'
+
+
+class Lifetimes:
+    """Reference counts of the Kurento objects this process created.
+
+    Every object is held by one or more owners (a room, a participant, the warm
+    pool). Once the last owner lets go the object is queued for release and the
+    queue goes out as one batch frame per session; elements of a pipeline that
+    is released in the same batch are skipped, Kurento drops them with it.
+
+    ``sweep`` asks the ServerManager for its pipelines and releases the ones
+    tagged with our ``tag`` that nobody here holds, e.g. left over by a crashed
+    worker with the same tag. A pipeline must look orphaned on two sweeps in a
+    row before it is released.
+    """
+
+    def __init__(self, tag: Optional[str] = None, window: float = 0.05, max_count: int = 64):
+        self.tag = tag or socket.gethostname()
+        self.objects: Dict[str, MediaBase] = {}
+        self.owners: Dict[str, Set[Hashable]] = {}
+        self.owned: Dict[Hashable, Set[str]] = {}
+        self.releaser = Coalescer(self._release_batch, window, max_count)
+        self.released = 0
+        self.reclaimed = 0
+        self._suspects: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def acquire(self, obj: MediaBase, owner: Hashable):
+        object_id = obj.object_id
+        assert object_id is not None
+        if object_id not in self.objects:
+            self.objects[object_id] = obj
+            self.owners[object_id] = set()
+            if isinstance(obj, MediaPipeline):
+                self._spawn(self._tag(obj))
+        self.owners[object_id].add(owner)
+        self.owned.setdefault(owner, set()).add(object_id)
+
+    def release(self, obj: MediaBase, owner: Hashable):
+        object_id = obj.object_id
+        if object_id is None or object_id not in self.objects:
+            return
+        self._let_go(object_id, owner)
+
+    def drop(self, owner: Hashable):
+        """Let go of everything ``owner`` holds."""
+        for object_id in self.owned.pop(owner, set()):
+            self._let_go(object_id, owner, forget_owner=False)
+
+    def _let_go(self, object_id: str, owner: Hashable, forget_owner: bool = True):
+        owners = self.owners[object_id]
+        owners.discard(owner)
+        if forget_owner:
+            owned = self.owned.get(owner)
+            if owned is not None:
+                owned.discard(object_id)
+                if not owned:
+                    del self.owned[owner]
+        if owners:
+            return
+        obj = self.objects.pop(object_id)
+        del self.owners[object_id]
+        if isinstance(obj, MediaPipeline):
+            # Its elements go with it
+            prefix = object_id + '/'
+            for child_id in [o for o in self.objects if o.startswith(prefix)]:
+                self.objects.pop(child_id).forget()
+                for child_owner in self.owners.pop(child_id):
+                    self.owned.get(child_owner, set()).discard(child_id)
+        self.releaser.add(obj)
+
+    async def _release_batch(self, objects: List[MediaBase]):
+        # Ids first, an element's id is gone once its pipeline is forgotten
+        ids = [(obj, obj.object_id) for obj in objects if obj.object_id is not None]
+        pipelines = {object_id for obj, object_id in ids if isinstance(obj, MediaPipeline)}
+        by_session: Dict[KurentoSession, List[str]] = {}
+        for obj, object_id in ids:
+            obj.forget()
+            if not (isinstance(obj, MediaElement) and object_id.split('/', 1)[0] in pipelines):
+                by_session.setdefault(obj.session, []).append(object_id)
+        await asyncio.gather(*(self.release_ids(session, ids) for session, ids in by_session.items()))
+
+    async def release_ids(self, session: KurentoSession, object_ids: List[str]):
+        futures = await session.send_batch((('release', {'object': object_id}) for object_id in object_ids),
+                                           priority=Priority.INTERACTIVE)
+        for object_id, result in zip(object_ids, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(result, Exception):
+                logger.error('Release of %s failed: %s', object_id, result)
+            else:
+                self.released += 1
+
+    async def _tag(self, pipeline: MediaPipeline):
+        try:
+            await (await pipeline.session.send_request('invoke', {
+                'object': pipeline.object_id,
+                'operation': 'addTag',
+                'operationParams': {'key': OWNER_TAG, 'value': self.tag},
+            }, priority=Priority.BACKGROUND))
+        except Exception as e:
+            logger.warning('Could not tag %s: %s', pipeline.object_id, e)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _invoke(self, session: KurentoSession, object_id: str, operation: str):
+        return (await (await session.send_request('invoke', {
+            'object': object_id,
+            'operation': operation,
+            'operationParams': {},
+        }, priority=Priority.BACKGROUND)))['value']
+
+    async def _is_ours(self, session: KurentoSession, pipeline_id: str) -> bool:
+        try:
+            tags = await self._invoke(session, pipeline_id, 'getTags')
+        except Exception:
+            # Released meanwhile, or not readable; either way not ours to reclaim
+            return False
+        return any(tag.get('key') == OWNER_TAG and tag.get('value') == self.tag for tag in tags or ())
+
+    async def sweep(self, session: KurentoSession) -> List[str]:
+        pipelines = await self._invoke(session, SERVER_MANAGER, 'getPipelines')
+        unknown = [p for p in pipelines if p not in self.objects]
+        ours = await asyncio.gather(*(self._is_ours(session, p) for p in unknown))
+        orphans = {p for p, mine in zip(unknown, ours) if mine}
+        reclaim = sorted(orphans & self._suspects)
+        self._suspects = orphans.difference(reclaim)
+        if reclaim:
+            logger.warning('Reclaiming %s orphaned pipelines', len(reclaim))
+            await self.release_ids(session, reclaim)
+            self.reclaimed += len(reclaim)
+        return reclaim
+
+    async def run_sweeper(self, session_for: Callable[[], KurentoSession], interval: float = 300.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep(session_for())
+            except Exception:
+                logger.exception('Leak sweep failed')
+
+    async def close(self):
+        await self.releaser.close()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            'objects': len(self.objects),
+            'owners': len(self.owned),
+            'released': self.released,
+            'reclaimed': self.reclaimed,
+            'suspects': len(self._suspects),
+        }
@@ -0,0 +1,229 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+from collections import deque
+from typing import Dict, List, Tuple, Optional, Deque, Set
+
+from roomserver.admission import InFlightBudget, UNBUDGETED_METHODS
+from roomserver.metrics import RPC_LATENCY, RPC_TIMEOUTS
+from roomserver.scheduling import Priority
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_TIMEOUTS: Dict[str, float] = {
+    'ping': 5.0,
+    'connect': 5.0,
+    'create': 15.0,
+    'invoke': 15.0,
+    'subscribe': 10.0,
+    'unsubscribe': 10.0,
+    'release': 10.0,
+}
+
+
+class JSONRpcTimeout(asyncio.TimeoutError):
+    def __init__(self, r_id: int, method: str, timeout: float):
+        self.r_id = r_id
+        self.method = method
+        self.timeout = timeout
+
+    def __str__(self):
+        return f'JSONRpcTimeout ({self.r_id}): {self.method} not answered in {self.timeout}s'
+
+
+class JSONRpcOverloaded(Exception):
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+
+    def __str__(self):
+        return f'JSONRpcOverloaded: {self.max_pending} requests already pending'
+
+
+def rpc_label(method: str, request: Optional[Dict]) -> str:
+    # 'invoke' alone would lump processOffer together with getters
+    if method == 'invoke' and request is not None:
+        return f"invoke:{request['params'].get('operation')}"
+    return method
+
+
+class PendingRequests:
+    """Futures of in-flight requests keyed by JSON-RPC id.
+
+    Entries leave the table as soon as they are answered, cancelled or timed out.
+    Deadlines live in one heap served by a single loop timer, rounded up to
+    ``resolution`` so that calls issued close together share a wake up.
+    Requests other than UNBUDGETED_METHODS also count against ``budget``,
+    shared by all links to one Kurento.
+    """
+
+    def __init__(self, max_pending: int = 1024, timeouts: Optional[Dict[str, float]] = None,
+                 default_timeout: float = DEFAULT_TIMEOUT, resolution: float = 0.5,
+                 budget: Optional[InFlightBudget] = None):
+        self.max_pending = max_pending
+        self.budget = budget
+        self._budgeted: Set[int] = set()
+        self.timeouts = dict(DEFAULT_TIMEOUTS if timeouts is None else timeouts)
+        self.default_timeout = default_timeout
+        self.resolution = resolution
+        self.timed_out = 0
+        self.orphaned = 0
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._sent: Dict[int, Dict] = {}
+        self._started: Dict[int, Tuple[str, float]] = {}
+        self._deadlines: List[Tuple[float, int, str, float]] = []
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __len__(self):
+        return len(self._futures)
+
+    def __contains__(self, r_id) -> bool:
+        return r_id in self._futures
+
+    def __getitem__(self, r_id) -> asyncio.Future:
+        return self._futures[r_id]
+
+    @property
+    def full(self) -> bool:
+        return len(self._futures) >= self.max_pending
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._futures),
+            'timed_out': self.timed_out,
+            'orphaned': self.orphaned,
+            'max_pending': self.max_pending,
+        }
+
+    def add(self, r_id: int, method: str, timeout: Optional[float] = None,
+            request: Optional[Dict] = None) -> asyncio.Future:
+        if self.full:
+            raise JSONRpcOverloaded(self.max_pending)
+        self._loop = asyncio.get_event_loop()
+        future = self._loop.create_future()
+        future.add_done_callback(lambda _, r_id=r_id: self._remove(r_id))
+        self._futures[r_id] = future
+        if request is not None:
+            self._sent[r_id] = request
+        self._started[r_id] = rpc_label(method, request), time.monotonic()
+        if self.budget is not None and method not in UNBUDGETED_METHODS:
+            self.budget.take()
+            self._budgeted.add(r_id)
+
+        if timeout is None:
+            timeout = self.timeouts.get(method, self.default_timeout)
+        if timeout:
+            heapq.heappush(self._deadlines, (self._loop.time() + timeout, r_id, method, timeout))
+            self._arm()
+        return future
+
+    def request(self, r_id) -> Optional[Dict]:
+        return self._sent.get(r_id)
+
+    def ids(self) -> List[int]:
+        return sorted(self._futures)
+
+    def pop(self, r_id) -> Optional[asyncio.Future]:
+        started = self._started.get(r_id)
+        future = self._remove(r_id)
+        if future is None:
+            self.orphaned += 1
+        elif started is not None:
+            RPC_LATENCY.labels(started[0]).observe(time.monotonic() - started[1])
+        return future
+
+    async def wait_for_room(self, count: int = 1, budgeted: Optional[int] = None,
+                            priority: Priority = Priority.NORMAL):
+        """Wait until ``count`` more requests fit, ``budgeted`` of them (default all) under the budget."""
+        budgeted = count if budgeted is None else budgeted
+        while True:
+            await self._wait_for_link_room(count)
+            budget = self.budget
+            if budget is None or not budgeted or budget.in_flight + min(budgeted, budget.limit) <= budget.limit:
+                return
+            await budget.wait(budgeted, priority)
+            if len(self._futures) + count <= self.max_pending:
+                return
+
+    async def _wait_for_link_room(self, count: int):
+        if count > self.max_pending:
+            raise JSONRpcOverloaded(self.max_pending)
+        while len(self._futures) + count > self.max_pending:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_next()
+                raise
+        if len(self._futures) + count < self.max_pending:
+            self._wake_next()
+
+    def cancel_all(self):
+        for future in list(self._futures.values()):
+            future.cancel()
+        self._clear_deadlines()
+
+    def fail_all(self, exc: Exception):
+        for future in list(self._futures.values()):
+            if not future.done():
+                future.set_exception(exc)
+        self._clear_deadlines()
+
+    def _clear_deadlines(self):
+        self._deadlines.clear()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _remove(self, r_id) -> Optional[asyncio.Future]:
+        self._sent.pop(r_id, None)
+        self._started.pop(r_id, None)
+        if r_id in self._budgeted:
+            self._budgeted.discard(r_id)
+            self.budget.give()
+        future = self._futures.pop(r_id, None)
+        if future is not None:
+            self._wake_next()
+        return future
+
+    def _wake_next(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _arm(self):
+        # Drop answered entries once they dominate the heap
+        if len(self._deadlines) > 2 * len(self._futures) + 64:
+            self._deadlines = [d for d in self._deadlines if d[1] in self._futures]
+            heapq.heapify(self._deadlines)
+        if not self._deadlines:
+            return
+        when = math.ceil(self._deadlines[0][0] / self.resolution) * self.resolution
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self._loop.call_at(when, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        now = self._loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, r_id, method, timeout = heapq.heappop(self._deadlines)
+            label = self._started.get(r_id, (method,))[0]
+            future = self._remove(r_id)
+            if future is None or future.done():
+                continue
+            self.timed_out += 1
+            RPC_TIMEOUTS.labels(label).inc()
+            logger.warning('Request %s (%s) timed out after %ss', r_id, method, timeout)
+            future.set_exception(JSONRpcTimeout(r_id, method, timeout))
+        self._arm()
@@ -13,6 +13,16 @@ class MediaPipeline(MediaBase):
     def __init__(self, session: KurentoSession):
         super().__init__(session)
 
+    @property
+    def object_id(self) -> Optional[str]:
+        return self.pipeline_id
+
+    def _drop_subscriptions(self):
+        # Releasing a pipeline releases every element in it
+        self.session.events.drop_object(self.object_id, children=True)
+        self.session.properties.drop_object(self.object_id, children=True)
+        self.subscriptions.clear()
+
     async def create(self):
         try:
             a_response = await self.session.send_request(method="create", params={
@@ -28,3 +38,6 @@ class MediaPipeline(MediaBase):
             self.pipeline_id = result['value']
             logger.info("MediaPipeline created: %s", self.pipeline_id)
 
+    def forget(self):
+        super().forget()
+        self.pipeline_id = None
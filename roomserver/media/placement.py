@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Iterable
+
+from roomserver.media.pipeline import MediaPipeline
+from roomserver.media.pool import KurentoPool, NoKurentoLink
+from roomserver.media.session import KurentoSession
+from roomserver.scheduling import Priority
+
+logger = logging.getLogger(__name__)
+
+SERVER_MANAGER = 'manager_ServerManager'
+
+
+class KurentoServer:
+    cpu: float = 0.0
+
+    def __init__(self, url: str, pool_size: int = 2, capacity: int = 100, **pool_kwargs):
+        self.url = url
+        self.capacity = capacity
+        self.pool = KurentoPool(url, pool_size, **pool_kwargs)
+        self.rooms: Dict[str, int] = {}
+
+    @property
+    def alive(self) -> bool:
+        return self.pool.alive
+
+    @property
+    def pipelines(self) -> int:
+        return sum(self.rooms.values())
+
+    def load(self, rpc_weight: float) -> float:
+        return self.pipelines / self.capacity + self.pool.pending * rpc_weight + self.cpu / 100
+
+    async def poll_cpu(self, interval_ms: int = 1000):
+        session = self.pool.session()
+        result = await (await session.send_request('invoke', {
+            'object': SERVER_MANAGER,
+            'operation': 'getUsedCpu',
+            'operationParams': {'interval': interval_ms},
+        }, priority=Priority.BACKGROUND))
+        self.cpu = float(result['value'])
+
+
+class Placement:
+    """Spreads rooms over several Kurento servers.
+
+    A room is placed on the least loaded live server when its first pipeline is
+    created and every later pipeline of the room goes to the same server. Load
+    combines placed pipelines, in-flight RPCs and the CPU usage reported by the
+    server's ServerManager.
+    """
+
+    def __init__(self, urls: Iterable[str], pool_size: int = 2, capacity: int = 100,
+                 rpc_weight: float = 0.01, cpu_interval: float = 5.0, **pool_kwargs):
+        self.servers: List[KurentoServer] = [KurentoServer(url, pool_size, capacity, **pool_kwargs) for url in urls]
+        self.rpc_weight = rpc_weight
+        self.cpu_interval = cpu_interval
+        self.rooms: Dict[str, KurentoServer] = {}
+        self._poller: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        for server in self.servers:
+            server.pool.start()
+        waiters = [asyncio.create_task(server.pool.wait_ready()) for server in self.servers]
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        self._poller = asyncio.create_task(self.poll())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._poller.cancel()
+        await asyncio.wait([self._poller])
+        for server in self.servers:
+            await server.pool.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def poll(self):
+        while True:
+            for server in self.servers:
+                if not server.alive:
+                    continue
+                try:
+                    await server.poll_cpu()
+                except Exception:
+                    logger.warning('Could not read CPU usage of %s', server.url)
+            await asyncio.sleep(self.cpu_interval)
+
+    def server_for(self, room_id: str) -> KurentoServer:
+        server = self.rooms.get(room_id)
+        if server is not None:
+            return server
+        alive = [server for server in self.servers if server.alive]
+        if not alive:
+            raise NoKurentoLink()
+        server = min(alive, key=lambda s: s.load(self.rpc_weight))
+        self.rooms[room_id] = server
+        server.rooms[room_id] = 0
+        logger.info('Room %s placed on %s', room_id, server.url)
+        return server
+
+    def session_for(self, room_id: str) -> KurentoSession:
+        return self.server_for(room_id).pool.session()
+
+    async def create_pipeline(self, room_id: str) -> MediaPipeline:
+        server = self.server_for(room_id)
+        pipeline = MediaPipeline(server.pool.session())
+        # Count it before the round trip so that concurrent placements see it
+        server.rooms[room_id] += 1
+        await pipeline.create()
+        if pipeline.pipeline_id is None and room_id in server.rooms:
+            server.rooms[room_id] -= 1
+        return pipeline
+
+    def release_room(self, room_id: str):
+        server = self.rooms.pop(room_id, None)
+        if server is not None:
+            server.rooms.pop(room_id, None)
+
+    @property
+    def stats(self) -> List[Dict]:
+        return [{
+            'url': server.url,
+            'alive': server.alive,
+            'rooms': len(server.rooms),
+            'pipelines': server.pipelines,
+            'pending': server.pool.pending,
+            'cpu': server.cpu,
+        } for server in self.servers]
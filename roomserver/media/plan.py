@@ -0,0 +1,146 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from .element import MediaElement
+from .pipeline import MediaPipeline
+from .session import KurentoSession
+from .web_rtc_endpoint import WebRTCEndPoint
+
+logger = logging.getLogger(__name__)
+
+StepCall = Callable[[Dict[str, Any]], Awaitable[Any]]
+UndoCall = Callable[[Any], Awaitable]
+
+
+class SetupFailed(Exception):
+    def __init__(self, step: str, error: BaseException):
+        self.step = step
+        self.error = error
+
+    def __str__(self):
+        return f'SetupFailed: step {self.step!r} failed: {self.error}'
+
+
+class Step:
+    __slots__ = ('name', 'call', 'after', 'undo')
+
+    def __init__(self, name: str, call: StepCall, after: Sequence[str], undo: Optional[UndoCall]):
+        self.name = name
+        self.call = call
+        self.after = tuple(after)
+        self.undo = undo
+
+
+class SetupPlan:
+    """A small DAG of Kurento calls.
+
+    Every step gets the results of all steps finished so far and runs as soon as
+    the steps it names in ``after`` are done, so independent calls are in flight
+    together. If a step fails the others are cancelled and the ``undo`` of every
+    finished step runs, latest first, before SetupFailed is raised.
+    """
+
+    def __init__(self):
+        self.steps: Dict[str, Step] = {}
+
+    def add(self, name: str, call: StepCall, after: Sequence[str] = (), undo: Optional[UndoCall] = None) -> str:
+        assert name not in self.steps, name
+        for dependency in after:
+            assert dependency in self.steps, f'{name} depends on unknown step {dependency}'
+        self.steps[name] = Step(name, call, after, undo)
+        return name
+
+    def value(self, name: str, value: Any, undo: Optional[UndoCall] = None) -> str:
+        """A step for an object that already exists, so other steps can depend on it."""
+        async def existing(results: Dict) -> Any:
+            return value
+
+        return self.add(name, existing, undo=undo)
+
+    def pipeline(self, name: str, session: KurentoSession) -> str:
+        async def create(results: Dict) -> MediaPipeline:
+            pipeline = MediaPipeline(session)
+            await pipeline.create()
+            if pipeline.pipeline_id is None:
+                raise RuntimeError('MediaPipeline was not created')
+            return pipeline
+
+        return self.add(name, create, undo=lambda pipeline: pipeline.release())
+
+    def endpoint(self, name: str, pipeline: str, session: KurentoSession) -> str:
+        async def create(results: Dict) -> WebRTCEndPoint:
+            endpoint = WebRTCEndPoint(results[pipeline], session)
+            await endpoint.create()
+            if endpoint.element_id is None:
+                raise RuntimeError('WebRtcEndpoint was not created')
+            return endpoint
+
+        return self.add(name, create, after=[pipeline], undo=lambda endpoint: endpoint.release())
+
+    def connect(self, name: str, source: str, sink: str) -> str:
+        async def connect(results: Dict) -> MediaElement:
+            if not await results[source].connect(results[sink]):
+                raise RuntimeError(f'{source} could not be connected to {sink}')
+            return results[sink]
+
+        return self.add(name, connect, after=[source, sink])
+
+    async def run(self) -> Dict[str, Any]:
+        results: Dict[str, Any] = {}
+        done: List[str] = []
+        waiting = dict(self.steps)
+        running: Dict[asyncio.Task, str] = {}
+        failed: Optional[SetupFailed] = None
+
+        def start_ready():
+            for name, step in list(waiting.items()):
+                if all(dependency in results for dependency in step.after):
+                    del waiting[name]
+                    running[asyncio.create_task(step.call(results))] = name
+
+        try:
+            start_ready()
+            while running and failed is None:
+                finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    name = running.pop(task)
+                    # A step that awaited a cancelled future, e.g. a shared subscription, ends cancelled itself
+                    if task.cancelled():
+                        failed = failed or SetupFailed(name, asyncio.CancelledError())
+                        continue
+                    if task.exception() is not None:
+                        failed = failed or SetupFailed(name, task.exception())
+                        continue
+                    results[name] = task.result()
+                    done.append(name)
+                if failed is None:
+                    start_ready()
+        finally:
+            if running:
+                for task in running:
+                    task.cancel()
+                await asyncio.wait(running)
+                # A step that finished while being cancelled still created its object
+                for task, name in running.items():
+                    if not task.cancelled() and task.exception() is None:
+                        results[name] = task.result()
+                        done.append(name)
+                if failed is None:
+                    failed = SetupFailed(next(iter(running.values())), asyncio.CancelledError())
+            if failed is not None:
+                await self.rollback(results, done)
+
+        if failed is not None:
+            raise failed
+        return results
+
+    async def rollback(self, results: Dict[str, Any], done: List[str]):
+        for name in reversed(done):
+            undo = self.steps[name].undo
+            if undo is None:
+                continue
+            try:
+                await undo(results[name])
+            except Exception:
+                logger.exception('Rollback of %s failed', name)
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import random
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from roomserver.admission import InFlightBudget
+from roomserver.media.events import EventRegistry
+from roomserver.media.properties import PropertyCache
+from roomserver.media.session import KurentoSession, JsonRPCProtocol, JsonRPCBase
+from roomserver.scheduling import Priority
+from roomserver.transport import WebSocketClient
+
+logger = logging.getLogger(__name__)
+
+
+class NoKurentoLink(Exception):
+    def __init__(self, session_id: Optional[str] = None):
+        self.session_id = session_id
+
+    def __str__(self):
+        if self.session_id is not None:
+            return f'NoKurentoLink: no link holds Kurento session {self.session_id}'
+        return 'NoKurentoLink: no connection to Kurento is up'
+
+
+class KurentoLinkLost(ConnectionResetError):
+    def __str__(self):
+        return 'KurentoLinkLost: connection dropped while the request was in flight'
+
+
+class KurentoSessionLost(ConnectionResetError):
+    def __str__(self):
+        return 'KurentoSessionLost: Kurento session could not be resumed'
+
+
+# Safe to send twice: they read state or converge to the same state
+REPLAYABLE_METHODS = frozenset({'ping', 'describe', 'unsubscribe', 'release'})
+
+
+def is_replayable(request: Dict) -> bool:
+    if request['method'] in REPLAYABLE_METHODS:
+        return True
+    return request['method'] == 'invoke' and request['params'].get('operation', '').startswith('get')
+
+
+class Backoff:
+    """Exponential backoff with full jitter."""
+
+    def __init__(self, initial: float = 0.1, maximum: float = 10.0, factor: float = 2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return random.uniform(0, delay)
+
+
+class KurentoLink:
+    protocol: Optional[JsonRPCProtocol] = None
+    session: Optional[KurentoSession] = None
+
+    def __init__(self, pool: 'KurentoPool', index: int):
+        self.pool = pool
+        self.index = index
+        self.base = JsonRPCBase(budget=pool.budget, **pool.base_kwargs)
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.backoff = Backoff(pool.retry_delay, pool.max_retry_delay)
+        self.reconnects = 0
+        self.rtt: Optional[float] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.ready.is_set()
+
+    @property
+    def pending(self) -> int:
+        return self.base.pending
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def bind(self, protocol: JsonRPCProtocol):
+        self.protocol = protocol
+        if self.session is None:
+            self.session = KurentoSession(protocol)
+        else:
+            # The session object outlives the socket; media objects keep their reference
+            self.session.protocol = protocol
+            protocol.set_callbacks(self.session, self.session)
+
+    async def resume(self) -> bool:
+        session_id = self.session.session_id
+        if session_id is None:
+            return True
+        try:
+            await (await self.session.send_request('connect', {}, priority=Priority.INTERACTIVE))
+        except Exception:
+            logger.exception('Link %s could not resume session %s', self.index, session_id)
+            return False
+        return True
+
+    async def restore(self, client: WebSocketClient):
+        # Anything pending with an id up to here was written to the old socket or
+        # issued during the outage; later ids already went out on this one
+        last_id = self.base.last_id
+        if not await self.resume():
+            self.base.fail_all(KurentoSessionLost())
+            self.session.events = EventRegistry()
+            self.session.properties = PropertyCache(self.session)
+            self.session.session_id = None
+        replay = [request for request in self.base.in_flight() if request['id'] <= last_id]
+        if replay:
+            logger.info('Link %s re-sending %s requests', self.index, len(replay))
+            await client.send_message(replay)
+        self.session.reconnecting = False
+
+    async def heartbeat(self, client: WebSocketClient):
+        # Kurento keeps the session for 'interval' ms after a ping; give it room for the misses
+        interval = self.pool.keepalive
+        params = {'interval': int(interval * (self.pool.keepalive_misses + 1) * 1000)}
+        loop = asyncio.get_event_loop()
+        missed = 0
+        while True:
+            await asyncio.sleep(interval)
+            start = loop.time()
+            try:
+                await (await self.session.send_request('ping', params, timeout=interval,
+                                                          priority=Priority.INTERACTIVE))
+            except Exception as e:
+                missed += 1
+                logger.warning('Link %s: ping %s/%s failed: %s', self.index, missed, self.pool.keepalive_misses, e)
+                if missed >= self.pool.keepalive_misses:
+                    logger.error('Link %s: Kurento stopped answering, dropping the link', self.index)
+                    client.dead = True
+                    client.disconnect()
+                    return
+            else:
+                missed = 0
+                self.rtt = loop.time() - start
+
+    def lost(self):
+        if not self.ready.is_set() and self.session is not None and self.session.reconnecting:
+            return
+        self.ready.clear()
+        if self.session is None:
+            return
+        self.session.reconnecting = True
+        # Events sent while the link is down are lost
+        self.session.properties.invalidate_all()
+        self.base.fail_requests([r for r in self.base.in_flight() if not is_replayable(r)], KurentoLinkLost())
+
+    async def run(self):
+        while True:
+            try:
+                async with WebSocketClient(self.pool.url, **self.pool.client_kwargs) as client:
+                    async with JsonRPCProtocol(client, self.base) as protocol:
+                        self.bind(protocol)
+                        await self.restore(client)
+                        self.ready.set()
+                        self.backoff.reset()
+                        logger.info('Link %s to %s is up', self.index, self.pool.url)
+                        heartbeat = asyncio.create_task(self.heartbeat(client)) if self.pool.keepalive else None
+                        try:
+                            await client.run()
+                        finally:
+                            if heartbeat is not None:
+                                heartbeat.cancel()
+                                await asyncio.wait([heartbeat])
+                        # Fail over now; closing a half-open socket can take a while
+                        self.lost()
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, OSError) as e:
+                logger.warning('Link %s to %s failed: %s', self.index, self.pool.url, e)
+            except Exception:
+                logger.exception('Link %s to %s failed', self.index, self.pool.url)
+            finally:
+                self.lost()
+            self.reconnects += 1
+            delay = self.backoff.next_delay()
+            logger.warning('Link %s is down, reconnecting in %.2fs', self.index, delay)
+            await asyncio.sleep(delay)
+
+
+class KurentoPool:
+    """N independent WebSocketClient links to one Kurento server.
+
+    Every link has its own JsonRPCProtocol, pending table and KurentoSession.
+    New sessions are handed out from the link with the fewest pending calls and
+    a sessionId stays pinned to the link that created it. A dead link is
+    reconnected with jittered backoff and resumes its Kurento session. Requests
+    in flight on it are re-sent if they are safe to repeat and fail with
+    KurentoLinkLost otherwise; requests made during the outage wait for the
+    new socket (bounded by their deadline). Every ``keepalive`` seconds a link
+    sends Kurento's ping and is dropped after ``keepalive_misses`` unanswered ones.
+    At most ``max_in_flight`` requests are outstanding over all links together;
+    further ones wait for a reply, so a burst queues here instead of at Kurento.
+    """
+
+    def __init__(self, url: str, size: int = 4, retry_delay: float = 0.1, max_retry_delay: float = 10.0,
+                 keepalive: Optional[float] = 5.0, keepalive_misses: int = 2,
+                 max_in_flight: Optional[int] = 256, base_kwargs: Optional[Dict] = None, **client_kwargs):
+        self.url = url
+        self.size = size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.keepalive = keepalive
+        self.keepalive_misses = keepalive_misses
+        self.budget = InFlightBudget(max_in_flight, url) if max_in_flight else None
+        self.base_kwargs = base_kwargs or {}
+        self.client_kwargs = client_kwargs
+        self.links: List[KurentoLink] = []
+
+    async def __aenter__(self):
+        self.start()
+        await self.wait_ready()
+        return self
+
+    def start(self):
+        self.links = [KurentoLink(self, index) for index in range(self.size)]
+        for link in self.links:
+            link.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for link in self.links:
+            link.task.cancel()
+        await asyncio.wait([link.task for link in self.links])
+        for link in self.links:
+            link.base.cancel_all()
+
+    async def wait_ready(self, timeout: Optional[float] = None):
+        waiters = [asyncio.create_task(link.ready.wait()) for link in self.links]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def run(self):
+        await asyncio.gather(*(link.task for link in self.links))
+
+    @property
+    def alive(self) -> bool:
+        return any(link.alive for link in self.links)
+
+    @property
+    def pending(self) -> int:
+        return sum(link.pending for link in self.links)
+
+    @property
+    def stats(self) -> List[Dict]:
+        return [dict(link.base.stats, link=link.index, alive=link.alive, reconnects=link.reconnects, rtt=link.rtt)
+                for link in self.links]
+
+    def link_for(self, session_id: Optional[str] = None) -> KurentoLink:
+        if session_id is not None:
+            for link in self.links:
+                if link.session is not None and link.session.session_id == session_id:
+                    return link
+            # Unknown, or lost with its link; its objects do not exist in any other session
+            raise NoKurentoLink(session_id)
+        alive = [link for link in self.links if link.alive]
+        if not alive:
+            raise NoKurentoLink()
+        return min(alive, key=lambda link: link.pending)
+
+    def session(self, session_id: Optional[str] = None) -> KurentoSession:
+        return self.link_for(session_id).session
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+from typing import Any, Dict, Tuple, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from roomserver.media.session import KurentoSession
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 1.0
+
+# Seconds a property read stays valid when no event says otherwise
+PROPERTY_TTLS: Dict[str, float] = {
+    'getName': 300.0,
+    'getStunServerAddress': 300.0,
+    'getStunServerPort': 300.0,
+    'getTurnUrl': 300.0,
+    'getMediaState': 30.0,
+    'getConnectionState': 30.0,
+    'getIceConnectionState': 30.0,
+    'getICECandidatePairs': 30.0,
+}
+
+# Kurento events that make a cached property stale
+INVALIDATED_BY: Dict[str, Tuple[str, ...]] = {
+    'getMediaState': ('MediaStateChanged',),
+    'getConnectionState': ('ConnectionStateChanged',),
+    'getIceConnectionState': ('IceComponentStateChange',),
+    'getICECandidatePairs': ('NewCandidatePairSelected', 'IceGatheringDone'),
+}
+
+
+class PropertyCache:
+    """Property reads of remote Kurento objects, kept per session.
+
+    A value is served from memory until its TTL runs out or one of the events in
+    INVALIDATED_BY arrives for its object; the cache subscribes to those events
+    on the first read. Concurrent reads of the same property share one invoke.
+    """
+
+    def __init__(self, session: 'KurentoSession', ttls: Optional[Dict[str, float]] = None,
+                 default_ttl: float = DEFAULT_TTL):
+        self.session = session
+        self.ttls = dict(PROPERTY_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self._values: Dict[Tuple[str, str], Tuple[Any, float]] = {}
+        self._reads: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._watched: Dict[Tuple[str, str], Any] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.invalidations = 0
+
+    async def get(self, object_id: str, operation: str) -> Any:
+        key = object_id, operation
+        cached = self._values.get(key)
+        if cached is not None and cached[1] > asyncio.get_event_loop().time():
+            self.hits += 1
+            return cached[0]
+        read = self._reads.get(key)
+        if read is None:
+            self.misses += 1
+            read = self._reads[key] = asyncio.create_task(self._read(key))
+        else:
+            self.shared += 1
+        # One caller giving up must not cancel the read for the others
+        return await asyncio.shield(read)
+
+    async def _read(self, key: Tuple[str, str]) -> Any:
+        object_id, operation = key
+        read = asyncio.current_task()
+        try:
+            _, result = await asyncio.gather(self._watch(object_id, operation), self._invoke(object_id, operation))
+            # An event during the read dropped it from _reads; the value is already stale
+            if self._reads.get(key) is read:
+                ttl = self.ttls.get(operation, self.default_ttl)
+                self._values[key] = result, asyncio.get_event_loop().time() + ttl
+            return result
+        finally:
+            if self._reads.get(key) is read:
+                del self._reads[key]
+
+    async def _invoke(self, object_id: str, operation: str) -> Any:
+        result = await (await self.session.send_request('invoke', {
+            'object': object_id,
+            'operation': operation,
+            'operationParams': {},
+        }))
+        return result['value']
+
+    async def _watch(self, object_id: str, operation: str):
+        for event_type in INVALIDATED_BY.get(operation, ()):
+            if (object_id, event_type) in self._watched:
+                continue
+
+            async def callback(data: Dict, event_type=event_type):
+                self.invalidate_event(object_id, event_type)
+
+            # Set first so concurrent reads do not subscribe twice; the next read retries a failed one
+            self._watched[object_id, event_type] = callback
+            try:
+                await self.session.subscribe(object_id, event_type, callback)
+            except asyncio.CancelledError:
+                self._watched.pop((object_id, event_type), None)
+                raise
+            except Exception:
+                self._watched.pop((object_id, event_type), None)
+                # The TTL still bounds how stale the value can get
+                logger.exception('Could not watch %s on %s', event_type, object_id)
+
+    def invalidate(self, object_id: str, operation: str):
+        key = object_id, operation
+        if self._values.pop(key, None) is not None or self._reads.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_event(self, object_id: str, event_type: str):
+        for operation, event_types in INVALIDATED_BY.items():
+            if event_type in event_types:
+                self.invalidate(object_id, operation)
+
+    def invalidate_all(self):
+        self.invalidations += len(self._values)
+        self._values.clear()
+        self._reads.clear()
+
+    def drop_object(self, object_id: str, children: bool = False):
+        prefix = object_id + '/'
+
+        def dropped(key: Tuple[str, str]) -> bool:
+            return key[0] == object_id or (children and key[0].startswith(prefix))
+
+        for table in (self._values, self._reads, self._watched):
+            for key in [key for key in table if dropped(key)]:
+                del table[key]
+
+    @property
+    def stats(self) -> Dict:
+        return {
+            'cached': len(self._values),
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'invalidations': self.invalidations,
+        }
@@ -1,9 +1,16 @@
 import asyncio
 import logging
+import time
 from pprint import pprint
-from typing import Dict, Awaitable, Optional, Tuple
+from typing import Dict, Awaitable, Optional, Tuple, Iterable, List, Union
 
+from roomserver.admission import InFlightBudget, UNBUDGETED_METHODS
+from roomserver.media.events import EventRegistry, Subscription, EventCallback
+from roomserver import scheduling, tracing
+from roomserver.media.pending import PendingRequests, JSONRpcOverloaded, rpc_label
+from roomserver.media.properties import PropertyCache
 from roomserver.protocol import ReaderWriterBase
+from roomserver.scheduling import Priority
 
 logger = logging.getLogger(__name__)
 
@@ -38,16 +45,22 @@ class JsonRPCProtocol(ReaderWriterBase):
         self.event_handler = event_handler
         self.s_i = s_i
 
-    async def on_message(self, msg):
+    async def on_message(self, msg: Union[Dict, List[Dict]]):
+        if isinstance(msg, list):
+            # JSON-RPC 2.0 batch: every reply resolves its own future
+            for item in msg:
+                await self.on_item(item)
+            return
+        await self.on_item(msg)
+
+    async def on_item(self, item: Dict):
         # logger.debug('media_server received %s', str(item))
         try:
-            # if not item:
-            #     logger.debug('media_server_sender Received End')
-            #     break
-            item = msg
             r_id = item.get('id')
             if r_id is None:
-                if item.get('method') == 'onEvent':
+                if 'error' in item:
+                    logger.error('Request rejected: %s', item['error'])
+                elif item.get('method') == 'onEvent':
                     if self.event_handler:
                         await self.event_handler.handle_event_response(item)
                     else:
@@ -57,11 +70,17 @@ class JsonRPCProtocol(ReaderWriterBase):
                     pprint(item)
                 return
 
-            if not self.base.request_with_id_exist(r_id):
+            future = self.base.pop_request(r_id)
+            if future is None:
                 logger.error("Unknown response: %s", str(item))
                 return
+            if self.base.traced:
+                rpc = self.base.traced.get(r_id)
+                if rpc is not None:
+                    rpc.reply(self.transport.inbound_queue.last_wait)
 
-            future = self.base.request_with_id(r_id)
+            if future.done():
+                return
             if 'error' in item:
                 future.set_exception(JSONRpcException(item['error']['code'], item['error']['message']))
             elif 'result' in item:
@@ -75,9 +94,12 @@ class JsonRPCProtocol(ReaderWriterBase):
 
 
 class JsonRPCBase:
-    def __init__(self):
+    def __init__(self, max_pending: int = 1024, timeouts: Optional[Dict[str, float]] = None,
+                 budget: Optional[InFlightBudget] = None):
         self._json_id: int = 0
-        self._requests: Dict[int, asyncio.Future] = {}
+        self._requests = PendingRequests(max_pending, timeouts, budget=budget)
+        # Requests made while a trace is active, by id
+        self.traced: Dict[int, 'tracing.RpcTrace'] = {}
 
     @property
     def incrementing_id(self):
@@ -98,23 +120,81 @@ class JsonRPCBase:
     def request_with_id(self, r_id) -> asyncio.Future:
         return self._requests[r_id]
 
-    def create_request(self, method: str, params: Dict, session_id: Optional[int] = None) -> Tuple[Dict, Awaitable]:
+    def pop_request(self, r_id) -> Optional[asyncio.Future]:
+        return self._requests.pop(r_id)
+
+    @property
+    def pending(self) -> int:
+        return len(self._requests)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self._requests.stats()
+
+    async def wait_for_room(self, count: int = 1, budgeted: Optional[int] = None,
+                            priority: Priority = Priority.NORMAL):
+        await self._requests.wait_for_room(count, budgeted, priority)
+
+    def cancel_all(self):
+        self._requests.cancel_all()
+
+    def fail_all(self, exc: Exception):
+        self._requests.fail_all(exc)
+
+    def fail_requests(self, requests: Iterable[Dict], exc: Exception):
+        for request in requests:
+            self.fail_request(request['id'], exc)
+
+    def fail_request(self, r_id, exc: Exception):
+        future = self._requests.pop(r_id)
+        if future is not None and not future.done():
+            future.set_exception(exc)
+
+    def create_request(self, method: str, params: Dict, session_id: Optional[int] = None,
+                       timeout: Optional[float] = None) -> Tuple[Dict, Awaitable]:
         r_id = self.incrementing_id
-        self._requests[r_id] = asyncio.Future()
         if session_id is not None:
             params['sessionId'] = session_id
-        return self._json_request(r_id, method, params), self._requests[r_id]
+        request = self._json_request(r_id, method, params)
+        return request, self._requests.add(r_id, method, timeout, request)
+
+    @property
+    def last_id(self) -> int:
+        return self._json_id
+
+    def in_flight(self) -> List[Dict]:
+        requests = (self._requests.request(r_id) for r_id in self._requests.ids())
+        return [request for request in requests if request is not None]
+
+    def create_batch(self, calls: Iterable[Tuple[str, Dict]],
+                     session_id: Optional[int] = None) -> Tuple[List[Dict], List[Awaitable]]:
+        calls = list(calls)
+        if len(self._requests) + len(calls) > self._requests.max_pending:
+            raise JSONRpcOverloaded(self._requests.max_pending)
+        requests = []
+        futures = []
+        for method, params in calls:
+            request, future = self.create_request(method, params, session_id)
+            requests.append(request)
+            futures.append(future)
+        return requests, futures
 
 
 class KurentoSession(EventHandlerInterface, SessionInterface):
     session_id: Optional[str] = None
+    # Set while the link is being re-established; requests wait for it instead of failing
+    reconnecting: bool = False
 
     async def handle_event_response(self, result: Dict):
-        print(result)
+        value = result.get('params', {}).get('value', {})
+        if not await self.events.dispatch(value.get('object'), value.get('type'), value.get('data', {})):
+            logger.debug('Unhandled event: %s', result)
 
     def __init__(self, protocol: JsonRPCProtocol):
         self.protocol = protocol
         self.protocol.set_callbacks(self, self)
+        self.events = EventRegistry()
+        self.properties = PropertyCache(self)
 
     def set_session_id(self, s_id: str):
         if self.session_id is not None:
@@ -123,8 +203,84 @@ class KurentoSession(EventHandlerInterface, SessionInterface):
             return
         self.session_id = s_id
 
-    async def send_request(self, method: str, params: Dict) -> Awaitable:
+    async def send_request(self, method: str, params: Dict, timeout: Optional[float] = None,
+                           priority: Optional[Priority] = None) -> Awaitable:
         # TODO: hide behind abstraction
-        request, future = self.protocol.base.create_request(method, params, self.session_id)
-        await self.protocol.transport.send_message(request)
+        if priority is None:
+            priority = scheduling.current.get()
+        trace = tracing.current.get()
+        started = time.monotonic() if trace is not None else 0.0
+        await self.protocol.base.wait_for_room(budgeted=0 if method in UNBUDGETED_METHODS else 1, priority=priority)
+        request, future = self.protocol.base.create_request(method, params, self.session_id, timeout)
+        if trace is not None:
+            tracing.trace_request(trace, self.protocol.base.traced, rpc_label(method, request), request, future,
+                                  started)
+        if not await self.protocol.transport.send_message(request, priority=priority) and not self.reconnecting:
+            self.protocol.base.fail_request(request['id'], ConnectionResetError('Kurento link is closed'))
         return future
+
+    async def send_batch(self, calls: Iterable[Tuple[str, Dict]],
+                         priority: Optional[Priority] = None) -> List[Awaitable]:
+        # Independent calls share one frame; replies may come back in any order
+        calls = list(calls)
+        if priority is None:
+            priority = scheduling.current.get()
+        trace = tracing.current.get()
+        started = time.monotonic() if trace is not None else 0.0
+        await self.protocol.base.wait_for_room(len(calls),
+                                               sum(method not in UNBUDGETED_METHODS for method, _ in calls), priority)
+        requests, futures = self.protocol.base.create_batch(calls, self.session_id)
+        if trace is not None:
+            for request, future in zip(requests, futures):
+                tracing.trace_request(trace, self.protocol.base.traced, rpc_label(request['method'], request),
+                                      request, future, started)
+        if requests and not await self.protocol.transport.send_message(requests, priority=priority) \
+                and not self.reconnecting:
+            for request in requests:
+                self.protocol.base.fail_request(request['id'], ConnectionResetError('Kurento link is closed'))
+        return futures
+
+    async def subscribe(self, object_id: str, event_type: str, callback: EventCallback) -> Subscription:
+        subscription = self.events.get(object_id, event_type)
+        if subscription is not None:
+            subscription.callbacks.append(callback)
+            try:
+                await asyncio.shield(subscription.ready)
+            except BaseException:
+                subscription.callbacks.remove(callback)
+                raise
+            return subscription
+
+        subscription = self.events.add(object_id, event_type)
+        subscription.callbacks.append(callback)
+        try:
+            result = await (await self.send_request('subscribe', {'type': event_type, 'object': object_id}))
+        except asyncio.CancelledError:
+            # Nobody will complete ``ready`` now; callers waiting on it are cancelled too
+            self.events.remove(subscription)
+            subscription.ready.cancel()
+            raise
+        except Exception as e:
+            self.events.remove(subscription)
+            subscription.ready.set_exception(e)
+            subscription.ready.exception()
+            raise
+        subscription.subscription_id = result['value']
+        subscription.ready.set_result(subscription.subscription_id)
+        return subscription
+
+    async def unsubscribe(self, subscription: Subscription, callback: Optional[EventCallback] = None):
+        if callback is not None and callback in subscription.callbacks:
+            subscription.callbacks.remove(callback)
+        if callback is not None and subscription.callbacks:
+            return
+        self.events.remove(subscription)
+        if subscription.subscription_id is None:
+            return
+        try:
+            await (await self.send_request('unsubscribe', {
+                'subscription': subscription.subscription_id,
+                'object': subscription.object_id,
+            }))
+        except Exception:
+            logger.exception('COMMAND: ')
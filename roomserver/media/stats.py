@@ -0,0 +1,247 @@
+import array
+import asyncio
+import collections
+import logging
+import math
+import random
+import time
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional
+
+from aiohttp import web
+
+from roomserver.metrics import STATS_POLL, STATS_FAILURES
+from roomserver.scheduling import Priority
+
+from .session import KurentoSession
+from .web_rtc_endpoint import WebRTCEndPoint
+
+logger = logging.getLogger(__name__)
+
+# (report type, field, how the reports of all streams are combined); a sample keeps one value per entry
+FIELDS = (
+    ('inboundrtp', 'bytesReceived', sum),
+    ('inboundrtp', 'packetsReceived', sum),
+    ('inboundrtp', 'packetsLost', sum),
+    ('inboundrtp', 'jitter', max),
+    ('inboundrtp', 'fractionLost', max),
+    ('outboundrtp', 'bytesSent', sum),
+    ('outboundrtp', 'packetsSent', sum),
+    ('outboundrtp', 'roundTripTime', max),
+    ('outboundrtp', 'targetBitrate', sum),
+)
+NAMES = tuple(field for _, field, _ in FIELDS)
+
+StatsListener = Callable[[float, Dict[str, Dict[str, float]]], Awaitable]
+
+
+def sample(reports: Dict[str, Dict]) -> array.array:
+    """The FIELDS of a getStats reply, NaN where no report has them."""
+    found: List[List[float]] = [[] for _ in FIELDS]
+    for report in reports.values():
+        report_type = report.get('type')
+        for values, (wanted, field, _) in zip(found, FIELDS):
+            if report_type == wanted:
+                value = report.get(field)
+                if isinstance(value, (int, float)):
+                    values.append(value)
+    return array.array('d', (combine(values) if values else math.nan
+                             for values, (_, _, combine) in zip(found, FIELDS)))
+
+
+def _plain(value: float):
+    # Counters go out as integers, not as 127500.0
+    return int(value) if value.is_integer() else value
+
+
+def as_dict(values: array.array) -> Dict[str, float]:
+    return {name: _plain(value) for name, value in zip(NAMES, values) if not math.isnan(value)}
+
+
+def delta(previous: Optional[array.array], values: array.array) -> Dict[str, float]:
+    if previous is None:
+        return as_dict(values)
+    return {name: _plain(value) for name, old, value in zip(NAMES, previous, values)
+            if value != old and not math.isnan(value)}
+
+
+class Series:
+    """The last ``history`` samples of one endpoint, one array of FIELDS each."""
+
+    __slots__ = ('times', 'samples')
+
+    def __init__(self, history: int):
+        self.times: Deque[float] = collections.deque(maxlen=history)
+        self.samples: Deque[array.array] = collections.deque(maxlen=history)
+
+    def add(self, when: float, values: array.array):
+        self.times.append(when)
+        self.samples.append(values)
+
+    @property
+    def latest(self) -> Optional[array.array]:
+        return self.samples[-1] if self.samples else None
+
+    def export(self) -> List[Dict]:
+        return [dict(as_dict(values), time=when) for when, values in zip(self.times, self.samples)]
+
+
+class StatsCollector:
+    """getStats of every live WebRtcEndpoint, polled once for all readers.
+
+    Every ``interval`` seconds, +/- ``jitter`` of it, the endpoints returned by
+    ``endpoints`` are polled as background traffic, up to ``batch`` calls per
+    frame and all frames in flight together. Each reply is reduced to FIELDS and
+    kept in a Series of ``history`` samples. After a round every listener gets
+    the fields that changed, by endpoint id, so readers never reach Kurento.
+    """
+
+    def __init__(self, endpoints: Callable[[], Iterable[WebRTCEndPoint]], interval: float = 5.0,
+                 jitter: float = 0.2, history: int = 60, batch: int = 32):
+        self.endpoints = endpoints
+        self.interval = interval
+        self.jitter = jitter
+        self.history = history
+        self.batch = batch
+        self.series: Dict[str, Series] = {}
+        self.listeners: List[StatsListener] = []
+        self.rounds = 0
+        self.failures = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+
+    def adjust(self, interval: Optional[float] = None, jitter: Optional[float] = None):
+        """Change the schedule; the next round is planned with the new values right away."""
+        if interval is not None:
+            self.interval = interval
+        if jitter is not None:
+            self.jitter = jitter
+        self._wake.set()
+
+    def latest(self, endpoint_id: str) -> Optional[Dict[str, float]]:
+        series = self.series.get(endpoint_id)
+        values = series.latest if series is not None else None
+        return as_dict(values) if values is not None else None
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            deadline = loop.time() + self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(0.0, deadline - loop.time()))
+                continue
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception('Stats round failed')
+
+    async def poll(self):
+        start = time.monotonic()
+        by_session: Dict[KurentoSession, List[str]] = {}
+        for endpoint in self.endpoints():
+            object_id = endpoint.object_id
+            if object_id is not None:
+                by_session.setdefault(endpoint.session, []).append(object_id)
+        for object_id in set(self.series) - {i for ids in by_session.values() for i in ids}:
+            del self.series[object_id]
+
+        now = time.time()
+        changes: Dict[str, Dict[str, float]] = {}
+        await asyncio.gather(*(self._poll_batch(session, ids[i:i + self.batch], now, changes)
+                               for session, ids in by_session.items()
+                               for i in range(0, len(ids), self.batch)))
+        self.rounds += 1
+        STATS_POLL.labels().observe(time.monotonic() - start)
+        if changes:
+            for listener in list(self.listeners):
+                try:
+                    await listener(now, changes)
+                except Exception:
+                    logger.exception('Stats listener failed')
+
+    async def _poll_batch(self, session: KurentoSession, object_ids: List[str], now: float,
+                          changes: Dict[str, Dict[str, float]]):
+        try:
+            futures = await session.send_batch((('invoke', {
+                'object': object_id,
+                'operation': 'getStats',
+                'operationParams': {},
+            }) for object_id in object_ids), priority=Priority.BACKGROUND)
+        except Exception as e:
+            self._failed(len(object_ids), e)
+            return
+        for object_id, result in zip(object_ids, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(result, Exception):
+                self._failed(1, result)
+                continue
+            values = sample(result.get('value') or {})
+            series = self.series.get(object_id)
+            if series is None:
+                series = self.series[object_id] = Series(self.history)
+            changed = delta(series.latest, values)
+            series.add(now, values)
+            if changed:
+                changes[object_id] = changed
+
+    def _failed(self, count: int, e: Exception):
+        self.failures += count
+        STATS_FAILURES.labels().inc(count)
+        logger.debug('getStats failed for %s endpoints: %s', count, e)
+
+    @property
+    def stats(self) -> Dict:
+        return {'endpoints': len(self.series), 'interval': self.interval, 'jitter': self.jitter,
+                'rounds': self.rounds, 'failures': self.failures}
+
+
+async def stats_handler(request: web.Request) -> web.Response:
+    """Latest sample of every endpoint, or the whole history of one with ``?endpoint=``."""
+    collector: Optional[StatsCollector] = request.app.get('stats')
+    if collector is None:
+        raise web.HTTPServiceUnavailable()
+    endpoint_id = request.query.get('endpoint')
+    if endpoint_id is not None:
+        series = collector.series.get(endpoint_id)
+        if series is None:
+            raise web.HTTPNotFound()
+        return web.json_response({'endpoint': endpoint_id, 'samples': series.export()})
+    return web.json_response({
+        'collector': collector.stats,
+        'endpoints': {object_id: collector.latest(object_id) for object_id in collector.series},
+    })
+
+
+async def stats_adjust_handler(request: web.Request) -> web.Response:
+    """Change the polling schedule with ``?interval=`` seconds and/or ``?jitter=`` share of it."""
+    collector: Optional[StatsCollector] = request.app.get('stats')
+    if collector is None:
+        raise web.HTTPServiceUnavailable()
+    try:
+        interval = float(request.query['interval']) if 'interval' in request.query else None
+        jitter = float(request.query['jitter']) if 'jitter' in request.query else None
+    except ValueError:
+        raise web.HTTPBadRequest(text='interval and jitter must be numbers')
+    if interval is not None and not interval > 0:
+        raise web.HTTPBadRequest(text='interval must be above 0')
+    if jitter is not None and not 0 <= jitter < 1:
+        raise web.HTTPBadRequest(text='jitter must be at least 0 and below 1')
+    collector.adjust(interval, jitter)
+    return web.json_response({'collector': collector.stats})
@@ -0,0 +1,164 @@
+import asyncio
+import collections
+import logging
+from typing import Callable, Deque, Dict, List, Optional
+
+from roomserver import scheduling
+from roomserver.scheduling import Priority
+
+from .lifetime import Lifetimes
+from .pipeline import MediaPipeline
+from .plan import SetupPlan, SetupFailed
+from .session import KurentoSession
+from .web_rtc_endpoint import WebRTCEndPoint
+
+logger = logging.getLogger(__name__)
+
+
+class WarmEntry:
+    __slots__ = ('session', 'session_id', 'pipeline', 'endpoints', 'created')
+
+    def __init__(self, session: KurentoSession, pipeline: MediaPipeline, endpoints: List[WebRTCEndPoint],
+                 created: float):
+        self.session = session
+        # Kurento drops the objects of a session it could not resume
+        self.session_id = session.session_id
+        self.pipeline = pipeline
+        self.endpoints = endpoints
+        self.created = created
+
+    @property
+    def stale(self) -> bool:
+        return self.session.session_id != self.session_id
+
+
+class WarmPool:
+    """Idle MediaPipelines, each with ``endpoints`` WebRtcEndpoints, created ahead of time.
+
+    ``take`` hands one out without a round trip. The pool is refilled in the
+    background, at most ``rate`` entries per second, and entries idle for longer
+    than ``ttl`` seconds are released. Idle entries are held in ``lifetimes``
+    by the pool until a room takes them over.
+    """
+
+    def __init__(self, session_for: Callable[[], KurentoSession], size: int = 4, endpoints: int = 1,
+                 rate: float = 2.0, ttl: float = 300.0, lifetimes: Optional[Lifetimes] = None):
+        self.session_for = session_for
+        self.lifetimes = lifetimes or Lifetimes()
+        self.size = size
+        self.endpoints = endpoints
+        self.rate = rate
+        self.ttl = ttl
+        self.idle: Deque[WarmEntry] = collections.deque()
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.failures = 0
+        self.expired = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        idle, self.idle = list(self.idle), collections.deque()
+        for entry in idle:
+            self.lifetimes.release(entry.pipeline, self)
+
+    def handed_over(self, entry: WarmEntry):
+        """Called once the taker holds the pipeline itself."""
+        self.lifetimes.release(entry.pipeline, self)
+
+    def take(self) -> Optional[WarmEntry]:
+        # Oldest first, so entries are used before they expire
+        while self.idle:
+            entry = self.idle.popleft()
+            if not entry.stale:
+                self.hits += 1
+                self._wake.set()
+                return entry
+            self.expired += 1
+            self.lifetimes.release(entry.pipeline, self)
+        self.misses += 1
+        self._wake.set()
+        return None
+
+    async def create(self) -> Optional[WarmEntry]:
+        session = self.session_for()
+        plan = SetupPlan()
+        plan.pipeline('pipeline', session)
+        names = [plan.endpoint(f'endpoint {i}', 'pipeline', session) for i in range(self.endpoints)]
+        try:
+            results = await plan.run()
+        except SetupFailed as e:
+            logger.warning('Warm pipeline could not be created: %s', e)
+            return None
+        self.lifetimes.acquire(results['pipeline'], self)
+        return WarmEntry(session, results['pipeline'], [results[name] for name in names],
+                         asyncio.get_event_loop().time())
+
+    async def expire(self) -> Optional[float]:
+        """Release expired entries and return when the next one expires."""
+        deadline = asyncio.get_event_loop().time() - self.ttl
+        expired = []
+        while self.idle and (self.idle[0].created <= deadline or self.idle[0].stale):
+            expired.append(self.idle.popleft())
+        if expired:
+            self.expired += len(expired)
+            for entry in expired:
+                self.lifetimes.release(entry.pipeline, self)
+        if self.idle:
+            return self.idle[0].created + self.ttl
+        return None
+
+    async def run(self):
+        # Refills must not hold up the signalling of rooms in use
+        scheduling.current.set(Priority.BACKGROUND)
+        loop = asyncio.get_event_loop()
+        while True:
+            next_expiry = await self.expire()
+            if len(self.idle) < self.size:
+                try:
+                    entry = await self.create()
+                except Exception:
+                    logger.exception('Warm pipeline could not be created')
+                    entry = None
+                if entry is None:
+                    self.failures += 1
+                else:
+                    self.refills += 1
+                    self.idle.append(entry)
+                await asyncio.sleep(1 / self.rate)
+                continue
+            self._wake.clear()
+            timeout = None if next_expiry is None else max(0.0, next_expiry - loop.time())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @property
+    def stats(self) -> Dict:
+        taken = self.hits + self.misses
+        return {
+            'idle': len(self.idle),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / taken if taken else None,
+            'refills': self.refills,
+            'failures': self.failures,
+            'expired': self.expired,
+        }
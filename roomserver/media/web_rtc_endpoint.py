@@ -1,8 +1,11 @@
+import asyncio
 import logging
+from typing import Dict, Iterable, Optional
 
 from roomserver.media.element import MediaElement
 from roomserver.media.pipeline import MediaPipeline
 from roomserver.media.session import KurentoSession
+from roomserver.scheduling import Priority
 
 logger = logging.getLogger(__name__)
 
@@ -29,3 +32,41 @@ class WebRTCEndPoint(MediaElement):
             assert self.pipeline.pipeline_id == pipeline_id
             self.element_id = element_id
             logger.info("WebRtcEndpoint created: %s", self.element_id)
+
+    async def process_offer(self, offer: str) -> Optional[str]:
+        try:
+            a_response = await self.session.send_request(method="invoke", params={
+                "object": self.object_id,
+                "operation": "processOffer",
+                "operationParams": {
+                    "offer": offer
+                },
+            }, priority=Priority.INTERACTIVE)
+            result = await a_response
+        except Exception:
+            logger.exception('COMMAND: ')
+            return None
+        else:
+            return result['value']
+
+    async def gather_candidates(self):
+        try:
+            a_response = await self.session.send_request(method="invoke", params={
+                "object": self.object_id,
+                "operation": "gatherCandidates",
+                "operationParams": {},
+            }, priority=Priority.INTERACTIVE)
+            await a_response
+        except Exception:
+            logger.exception('COMMAND: ')
+
+    async def add_ice_candidates(self, candidates: Iterable[Dict]):
+        # One frame for all candidates; replies are awaited together, not one by one
+        futures = await self.session.send_batch((("invoke", {
+            "object": self.object_id,
+            "operation": "addIceCandidate",
+            "operationParams": {"candidate": candidate},
+        }) for candidate in candidates), priority=Priority.INTERACTIVE)
+        for result in await asyncio.gather(*futures, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error('addIceCandidate failed on %s: %s', self.element_id, result)
@@ -0,0 +1,246 @@
+import asyncio
+import bisect
+import collections
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a loopback RPC (~100us) up to a stuck Kurento call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """Base of the metric families below.
+
+    Everything runs on the event loop, so children are plain attributes updated
+    without locks and a scrape only reads them.
+    """
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            assert len(key) == len(self.labelnames), self.name
+            child = self._children[key] = self._child()
+        return child
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _samples(self, key: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for key, child in list(self._children.items()):
+            lines.extend(self._samples(key, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from ``function`` at scrape time."""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                logger.exception('Metric callback failed')
+                return math.nan
+        return self.value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self):
+        return _Value()
+
+    def _samples(self, key, child) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}']
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+
+class _Buckets:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def _samples(self, key, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            le = 'le="' + _format_value(bound) + '"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {child.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        assert metric.name not in self.metrics, metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+RPC_LATENCY = REGISTRY.register(Histogram(
+    'roomserver_kurento_rpc_seconds', 'Kurento JSON-RPC round trip time by method', ['method']))
+RPC_TIMEOUTS = REGISTRY.register(Counter(
+    'roomserver_kurento_rpc_timeouts_total', 'Kurento JSON-RPC requests that timed out', ['method']))
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    'roomserver_queue_wait_seconds', 'Time messages spend in WebSocket queues', ['peer', 'direction']))
+OUTBOUND_WAIT = REGISTRY.register(Histogram(
+    'roomserver_outbound_wait_seconds', 'Time outbound messages wait by priority class', ['peer', 'priority']))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'roomserver_queue_depth', 'Messages queued on open WebSockets', ['peer', 'direction']))
+WS_BYTES = REGISTRY.register(Counter(
+    'roomserver_websocket_bytes_total', 'WebSocket payload bytes', ['peer', 'direction']))
+WS_CONNECTION_BYTES = REGISTRY.register(Histogram(
+    'roomserver_websocket_connection_bytes', 'Payload bytes per closed WebSocket', ['peer', 'direction'],
+    buckets=BYTES_BUCKETS))
+WS_OPEN = REGISTRY.register(Gauge(
+    'roomserver_websockets', 'Open WebSockets', ['peer']))
+WS_RTT = REGISTRY.register(Histogram(
+    'roomserver_websocket_rtt_seconds', 'WebSocket ping/pong round trip time', ['peer']))
+WS_FRAMING = REGISTRY.register(Counter(
+    'roomserver_websocket_framing_total', 'Browser WebSockets by negotiated codec and compression',
+    ['codec', 'compression']))
+WS_DEAD = REGISTRY.register(Counter(
+    'roomserver_websocket_dead_total', 'WebSockets closed because the peer stopped answering', ['peer']))
+RPC_IN_FLIGHT = REGISTRY.register(Gauge(
+    'roomserver_kurento_rpc_in_flight', 'Kurento JSON-RPC requests in flight over all links of a pool', ['pool']))
+ADMISSION = REGISTRY.register(Counter(
+    'roomserver_admission_total', 'Admission decisions', ['kind', 'outcome']))
+JOIN_WAIT = REGISTRY.register(Histogram(
+    'roomserver_join_queue_wait_seconds', 'Time joins wait for admission'))
+STATS_POLL = REGISTRY.register(Histogram(
+    'roomserver_stats_poll_seconds', 'Time to poll getStats of all live endpoints'))
+STATS_FAILURES = REGISTRY.register(Counter(
+    'roomserver_stats_failures_total', 'getStats calls that failed'))
+LOOP_LAG = REGISTRY.register(Histogram(
+    'roomserver_event_loop_lag_seconds', 'How late the event loop runs a timer'))
+ROOMS = REGISTRY.register(Gauge('roomserver_rooms', 'Rooms in this worker'))
+PARTICIPANTS = REGISTRY.register(Gauge('roomserver_participants', 'Participants in this worker'))
+
+
+class TimedQueue(asyncio.Queue):
+    """asyncio.Queue that reports how long every item waited in it."""
+
+    def __init__(self, maxsize: int = 0, wait: Optional[_Buckets] = None):
+        super().__init__(maxsize)
+        self.wait = wait
+        # Wait of the item returned by the last get, for tracing
+        self.last_wait = 0.0
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._times = collections.deque()
+
+    def _put(self, item):
+        super()._put(item)
+        self._times.append(time.monotonic())
+
+    def _get(self):
+        item = super()._get()
+        self.last_wait = time.monotonic() - self._times.popleft()
+        if self.wait is not None:
+            self.wait.observe(self.last_wait)
+        return item
+
+
+async def monitor_loop_lag(interval: float = 0.25):
+    lag = LOOP_LAG.labels()
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - start - interval))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-cache'})
@@ -1,23 +1,50 @@
 import asyncio
+from typing import Any, Optional, Union
 
-from .transport import WebSocketResponse
+from . import tracing
+from .transport import WebSocketResponse, LeanWebSocketResponse
 
 
 class ReaderWriterBase:
-    def __init__(self, transport: WebSocketResponse):
+    # Start a trace (if sampled) for every message read from the transport
+    traced = False
+
+    def __init__(self, transport: Union[WebSocketResponse, LeanWebSocketResponse]):
         self.transport = transport
 
+    t: Optional[asyncio.Task] = None
+
     async def __aenter__(self):
-        self.t = asyncio.create_task(self.run())
+        if self.transport.lean:
+            # A lean transport has no inbound queue, it calls dispatch from its own receive loop
+            self.transport.handler = self.dispatch
+        else:
+            self.t = asyncio.create_task(self.run())
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        self.t.cancel()
+        if self.t is not None:
+            self.t.cancel()
 
     async def run(self):
         while True:
-            await self.on_message(await self.transport.inbound_queue.get())
+            msg = await self.transport.inbound_queue.get()
+            await self.dispatch(msg, self.transport.inbound_queue.last_wait)
             self.transport.inbound_queue.task_done()
 
+    async def dispatch(self, msg: Any, queue_wait: float):
+        trace = None
+        if self.traced and isinstance(msg, dict):
+            trace = tracing.tracer.start(str(msg.get('type')), queue_wait)
+        if trace is None:
+            await self.on_message(msg)
+            return
+        token = tracing.current.set(trace)
+        try:
+            await self.on_message(msg)
+        finally:
+            tracing.current.reset(token)
+            tracing.tracer.finish(trace)
+
     async def on_message(self, msg):
         raise NotImplementedError
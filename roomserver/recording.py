@@ -0,0 +1,130 @@
+import asyncio
+import enum
+import itertools
+import json
+import logging
+import struct
+import time
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RSREC1\n'
+# kind, flags, seconds since the recording started, connection, payload length
+HEADER = struct.Struct('<BBdII')
+TEXT = 1
+
+
+class Kind(enum.IntEnum):
+    # A recording was (re)started; the payload holds the wall clock time as JSON
+    START = 0
+    # A connection was opened; the payload holds its peer and codec as JSON
+    OPEN = 1
+    # A frame received by the roomserver
+    IN = 2
+    # A frame sent by the roomserver
+    OUT = 3
+    CLOSE = 4
+
+
+class Record(NamedTuple):
+    kind: Kind
+    time: float
+    connection: int
+    payload: Union[str, bytes]
+
+    def info(self) -> Dict:
+        return json.loads(self.payload)
+
+
+class Recorder:
+    """Appends every WebSocket frame the roomserver sends or receives to ``path``.
+
+    Records are a fixed header and the frame as it went over the wire, stamped
+    with time.monotonic() relative to when the recording started, so a frame
+    costs one struct.pack and one buffered write. Text frames are stored as
+    UTF-8 and flagged. The buffer goes to disk every ``flush_interval``
+    seconds and on close; every run appends a START record of its own.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, buffering: int = 1 << 16):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.frames = 0
+        self.bytes = 0
+        self._file: BinaryIO = open(path, 'ab', buffering=buffering)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._start = time.monotonic()
+        self._ids = itertools.count(1)
+        self._task: Optional[asyncio.Task] = None
+        self._write(Kind.START, 0, json.dumps({'wall': time.time()}))
+
+    def _write(self, kind: Kind, connection: int, payload: Union[str, bytes]) -> int:
+        if self._file.closed:
+            # Sockets still open at shutdown
+            return 0
+        flags = 0
+        if isinstance(payload, str):
+            payload = payload.encode()
+            flags = TEXT
+        self._file.write(HEADER.pack(kind, flags, time.monotonic() - self._start, connection, len(payload)))
+        self._file.write(payload)
+        return len(payload)
+
+    def open(self, peer: str, codec: str) -> int:
+        """Record a new connection and return its id for ``frame`` and ``close``."""
+        connection = next(self._ids)
+        self._write(Kind.OPEN, connection, json.dumps({'peer': peer, 'codec': codec}))
+        return connection
+
+    def frame(self, connection: int, kind: Kind, payload: Union[str, bytes]):
+        self.frames += 1
+        self.bytes += self._write(kind, connection, payload)
+
+    def close_connection(self, connection: int):
+        self._write(Kind.CLOSE, connection, b'')
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._file.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.wait([self._task])
+            self._task = None
+        if not self._file.closed:
+            self._file.close()
+            logger.info('Recorded %s frames / %s bytes to %s', self.frames, self.bytes, self.path)
+
+
+def read_runs(path: str) -> List[List[Record]]:
+    """Records of ``path`` split at every START; connection ids are per run."""
+    runs: List[List[Record]] = []
+    for record in read_records(path):
+        if record.kind == Kind.START:
+            runs.append([])
+        if runs:
+            runs[-1].append(record)
+    return runs
+
+
+def read_records(path: str) -> Iterator[Record]:
+    """Records of ``path`` in order; a truncated last record is skipped."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a roomserver recording')
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, flags, when, connection, length = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield Record(Kind(kind), when, connection, payload.decode() if flags & TEXT else payload)
@@ -0,0 +1,323 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+from contextlib import suppress
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from roomserver.codec import SUBPROTOCOLS, codecs, get_codec
+from roomserver.recording import Kind, Record, read_runs
+
+logger = logging.getLogger(__name__)
+
+# Browser messages answered by the roomserver, and the answers that end their wait
+ANSWERS = {'join': ('joined', 'tryLater', 'redirect', 'error'), 'offer': ('answer', 'error')}
+
+
+def rough_key(request: Dict) -> Tuple:
+    params = request.get('params') or {}
+    return request.get('method'), params.get('operation') or params.get('type')
+
+
+def exact_key(request: Dict) -> str:
+    params = {k: v for k, v in (request.get('params') or {}).items() if k != 'sessionId'}
+    return json.dumps([request.get('method'), params], sort_keys=True)
+
+
+class Answer:
+    """A recorded reply, the time Kurento took for it and the events that followed it."""
+
+    __slots__ = ('reply', 'latency', 'events', 'used')
+
+    def __init__(self, reply: Dict, latency: float):
+        self.reply = reply
+        self.latency = latency
+        self.events: List[Tuple[float, Any]] = []
+        self.used = False
+
+
+class ReplayKurento:
+    """Answers the roomserver's Kurento requests from a recorded run.
+
+    A request gets the reply recorded for the same method and params, or else
+    for the next unused request of the same method and operation, after the
+    recorded latency divided by ``speed``. Events Kurento sent after a reply are
+    sent on the live connection after it with their recorded delays. Requests
+    that match nothing get a JSON-RPC error, pings are always answered.
+    """
+
+    def __init__(self, records: List[Record], speed: float = 1.0):
+        self.speed = speed
+        self.exact: Dict[str, Deque[Answer]] = collections.defaultdict(collections.deque)
+        self.rough: Dict[Tuple, Deque[Answer]] = collections.defaultdict(collections.deque)
+        self.answered = 0
+        self.fallbacks = 0
+        self.unmatched = 0
+        self.events = 0
+        self.connected = asyncio.Event()
+        self._load(records)
+
+    def _load(self, records: List[Record]):
+        kurento = {r.connection for r in records if r.kind == Kind.OPEN and r.info()['peer'] == 'kurento'}
+        sent: Dict[Tuple[int, Any], Tuple[Dict, float]] = {}
+        # Last reply on every connection and when its last reply or event came
+        last: Dict[int, Answer] = {}
+        last_time: Dict[int, float] = {}
+        for record in records:
+            if record.connection not in kurento or record.kind not in (Kind.IN, Kind.OUT):
+                continue
+            data = json.loads(record.payload)
+            for item in data if isinstance(data, list) else [data]:
+                if record.kind == Kind.OUT:
+                    if 'id' in item:
+                        sent[record.connection, item['id']] = item, record.time
+                elif 'id' in item:
+                    request, at = sent.pop((record.connection, item['id']), (None, 0.0))
+                    if request is None:
+                        continue
+                    answer = last[record.connection] = Answer(item, record.time - at)
+                    last_time[record.connection] = record.time
+                    self.exact[exact_key(request)].append(answer)
+                    self.rough[rough_key(request)].append(answer)
+                elif record.connection in last:
+                    last[record.connection].events.append((record.time - last_time[record.connection], item))
+                    last_time[record.connection] = record.time
+
+    def _take(self, queue: Deque[Answer]) -> Optional[Answer]:
+        while queue:
+            answer = queue.popleft()
+            if not answer.used:
+                answer.used = True
+                return answer
+        return None
+
+    def match(self, request: Dict) -> Tuple[Dict, float, List[Tuple[float, Any]]]:
+        answer = self._take(self.exact.get(exact_key(request), collections.deque()))
+        if answer is None:
+            answer = self._take(self.rough.get(rough_key(request), collections.deque()))
+            if answer is not None:
+                self.fallbacks += 1
+        r_id = request.get('id')
+        if answer is None:
+            if request.get('method') == 'ping':
+                return {'id': r_id, 'result': {'value': 'pong'}, 'jsonrpc': '2.0'}, 0.0, []
+            self.unmatched += 1
+            logger.warning('No recorded reply for %s', rough_key(request))
+            return {'id': r_id, 'error': {'code': -32000, 'message': 'Not in the recording'},
+                    'jsonrpc': '2.0'}, 0.0, []
+        self.answered += 1
+        reply = dict(answer.reply, id=r_id)
+        params = request.get('params') or {}
+        pipeline = (params.get('constructorParams') or {}).get('mediaPipeline')
+        value = (reply.get('result') or {}).get('value')
+        if pipeline and isinstance(value, str) and '/' in value:
+            # An element recorded in another pipeline now lives in the requested one
+            reply['result'] = dict(reply['result'], value=pipeline + '/' + value.split('/', 1)[1])
+        return reply, answer.latency, answer.events
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.get('/{path:.*}', self.websocket_handler)])
+        return app
+
+    async def websocket_handler(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connected.set()
+        tasks = set()
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                task = asyncio.create_task(self.dispatch(json.loads(msg.data), ws))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return ws
+
+    async def dispatch(self, data: Any, ws: web.WebSocketResponse):
+        matches = [self.match(item) for item in (data if isinstance(data, list) else [data]) if 'id' in item]
+        if not matches:
+            return
+        await self.sleep(max(latency for _, latency, _ in matches))
+        replies = [reply for reply, _, _ in matches]
+        await ws.send_str(json.dumps(replies if isinstance(data, list) else replies[0]))
+        for _, _, events in matches:
+            for delay, event in events:
+                await self.sleep(delay)
+                if ws.closed:
+                    return
+                self.events += 1
+                await ws.send_str(json.dumps(event))
+
+    async def sleep(self, delay: float):
+        if self.speed and delay > 0:
+            await asyncio.sleep(delay / self.speed)
+
+    @property
+    def stats(self) -> Dict:
+        return {'answered': self.answered, 'fallbacks': self.fallbacks, 'unmatched': self.unmatched,
+                'events': self.events}
+
+
+class ReplayBrowsers:
+    """Opens the recorded browser connections against a live roomserver and sends what they sent.
+
+    Connections open and send at their recorded times divided by ``speed``,
+    counted from the first browser connection. A connection waits for the
+    answers to its joins and offers before it sends anything else, so
+    acceleration does not reorder a join and the offer that depends on it.
+    Latencies are measured from sending a message to its answer in ANSWERS.
+    """
+
+    def __init__(self, records: List[Record], url: str, speed: float = 1.0, answer_timeout: float = 10.0):
+        self.url = url
+        self.speed = speed
+        self.answer_timeout = answer_timeout
+        self.connections: Dict[int, Tuple[Dict, List[Record]]] = {}
+        for record in records:
+            if record.kind == Kind.OPEN and record.info()['peer'] == 'browser':
+                self.connections[record.connection] = record.info(), [record]
+            elif record.connection in self.connections and record.kind in (Kind.IN, Kind.CLOSE):
+                self.connections[record.connection][1].append(record)
+        self.origin = min((frames[0].time for _, frames in self.connections.values()), default=0.0)
+        self.sent = 0
+        self.received = 0
+        self.failed = 0
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+
+    async def run(self):
+        await asyncio.gather(*(self.connection(info, frames) for info, frames in self.connections.values()))
+
+    async def at(self, start: float, when: float):
+        if self.speed:
+            delay = start + (when - self.origin) / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def connection(self, info: Dict, frames: List[Record]):
+        start = time.monotonic()
+        name = info['codec']
+        codec = codecs[name]() if name in codecs else get_codec()
+        protocols = [p for p, codec_name in SUBPROTOCOLS.items() if codec_name == name and codec.binary]
+        await self.at(start, frames[0].time)
+        pending: Deque[Tuple[str, float]] = collections.deque()
+        answered = asyncio.Event()
+        answered.set()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(self.url, protocols=protocols) as ws:
+                    reader = asyncio.create_task(self.read(ws, codec, pending, answered))
+                    try:
+                        for record in frames[1:]:
+                            await self.at(start, record.time)
+                            if record.kind == Kind.CLOSE:
+                                break
+                            if not answered.is_set():
+                                with suppress(asyncio.TimeoutError):
+                                    await asyncio.wait_for(answered.wait(), self.answer_timeout)
+                            message = codec.loads(record.payload)
+                            kind = message.get('type') if isinstance(message, dict) else None
+                            if kind in ANSWERS:
+                                pending.append((kind, time.monotonic()))
+                                answered.clear()
+                            if codec.binary:
+                                await ws.send_bytes(record.payload)
+                            else:
+                                await ws.send_str(record.payload if isinstance(record.payload, str)
+                                                  else record.payload.decode())
+                            self.sent += 1
+                    finally:
+                        reader.cancel()
+        except (aiohttp.ClientError, ConnectionError) as e:
+            self.failed += 1
+            logger.warning('Browser connection failed: %r', e)
+
+    async def read(self, ws: aiohttp.ClientWebSocketResponse, codec, pending: Deque[Tuple[str, float]],
+                   answered: asyncio.Event):
+        async for msg in ws:
+            if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                continue
+            self.received += 1
+            message = codec.loads(msg.data)
+            kind = message.get('type') if isinstance(message, dict) else None
+            for i, (request, sent) in enumerate(pending):
+                if kind in ANSWERS[request]:
+                    self.latencies[request].append(time.monotonic() - sent)
+                    del pending[i]
+                    if not pending:
+                        answered.set()
+                    break
+
+    @property
+    def stats(self) -> Dict:
+        return {'connections': len(self.connections), 'failed': self.failed, 'sent': self.sent,
+                'received': self.received}
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def report(browsers: ReplayBrowsers, kurento: ReplayKurento, elapsed: float, speed: float):
+    print(f'replayed {browsers.sent} browser messages in {elapsed:.2f}s '
+          f'({browsers.sent / elapsed if elapsed else 0:.0f}/s), speed {speed or "max"}')
+    print('browsers', browsers.stats)
+    print('kurento ', kurento.stats)
+    print(f'{"answer":8} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for request, values in browsers.latencies.items():
+        print(f'{request:8} {len(values):6} {percentile(values, 0.5) * 1e3:8.1f}'
+              f' {percentile(values, 0.95) * 1e3:8.1f} {percentile(values, 0.99) * 1e3:8.1f}')
+
+
+async def run(args):
+    runs = read_runs(args.log)
+    if not runs:
+        raise SystemExit(f'{args.log} holds no recording')
+    records = runs[args.run]
+    kurento = ReplayKurento(records, args.speed)
+    runner = web.AppRunner(kurento.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f'Kurento stand-in on ws://{args.host}:{args.port}/kurento, '
+          f'{sum(map(len, kurento.rough.values()))} recorded replies', flush=True)
+    try:
+        if args.browsers is None:
+            # Kurento only, until interrupted
+            await asyncio.Event().wait()
+        browsers = ReplayBrowsers(records, args.browsers, args.speed)
+        # The roomserver is ready once it has connected to us
+        await kurento.connected.wait()
+        await asyncio.sleep(args.settle)
+        start = time.monotonic()
+        await browsers.run()
+        report(browsers, kurento, time.monotonic() - start, args.speed)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recording made with rs --record')
+    parser.add_argument('log')
+    parser.add_argument('--run', type=int, default=-1, help='which run of the file, default the last')
+    parser.add_argument('--speed', type=float, default=1.0, help='time scale, 0 for as fast as possible')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8888, help='port of the Kurento stand-in')
+    parser.add_argument('--browsers', metavar='URL', help='also replay the browsers against this /ws URL')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds between the roomserver connecting and the first browser')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
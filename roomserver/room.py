@@ -0,0 +1,360 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, Optional, Callable, Any, List, Iterable, Set
+
+from .admission import Admission, TryLater
+from .codec import FrameCodec, Payload
+from .media.ice import IceRelay
+from .media.lifetime import Lifetimes
+from .media.pipeline import MediaPipeline
+from .media.plan import SetupPlan, SetupFailed
+from .media.pool import NoKurentoLink
+from .media.session import KurentoSession
+from .media.stats import StatsCollector
+from .media.warm import WarmPool
+from .metrics import ADMISSION
+from .media.web_rtc_endpoint import WebRTCEndPoint
+from .protocol import ReaderWriterBase
+from .routing import WorkerRouter
+from .transport import WebSocketBase
+
+logger = logging.getLogger(__name__)
+
+
+class Participant:
+    endpoint: Optional[WebRTCEndPoint] = None
+    ice: Optional[IceRelay] = None
+
+    def __init__(self, room: 'Room', transport: WebSocketBase, name: str = ''):
+        self.room = room
+        self.transport = transport
+        self.participant_id = uuid.uuid4().hex
+        self.name = name
+        self.publishing = False
+
+    def describe(self) -> Dict:
+        return {'id': self.participant_id, 'name': self.name, 'publishing': self.publishing}
+
+    async def send(self, message: Dict):
+        await self.transport.send_message(message)
+
+
+class Room:
+    """Participants sharing one MediaPipeline.
+
+    Broadcasts are encoded once per codec in use and the same payload is queued
+    on every member's socket, so a room message costs one encode per framing
+    and one write per member.
+    """
+
+    pipeline: Optional[MediaPipeline] = None
+
+    def __init__(self, room_id: str, session: KurentoSession, codec: Optional[FrameCodec] = None,
+                 warm: Optional[WarmPool] = None, lifetimes: Optional[Lifetimes] = None):
+        self.room_id = room_id
+        self.session = session
+        self.codec = codec or FrameCodec()
+        self.warm = warm
+        # The room holds the pipeline, every participant holds its endpoint
+        self.lifetimes = lifetimes or Lifetimes()
+        self.participants: Dict[str, Participant] = {}
+        # Endpoints that came with a warm pipeline and are not used yet
+        self.spare: List[WebRTCEndPoint] = []
+        # Participants that get the stats of everybody in the room pushed
+        self.stats_subscribers: Set[Participant] = set()
+        # Joins waiting for or running under the lock; the room is not empty while there are any
+        self.joining = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.participants)
+
+    async def broadcast(self, message: Dict, exclude: Optional[Participant] = None,
+                        droppable: Optional[bool] = None, to: Optional[Iterable[Participant]] = None):
+        payloads: Dict[str, Payload] = {}
+        for participant in list(self.participants.values() if to is None else to):
+            if participant is exclude:
+                continue
+            codec = participant.transport.codec
+            if codec.name == self.codec.name:
+                codec = self.codec
+            payload = payloads.get(codec.name)
+            if payload is None:
+                payload = payloads[codec.name] = await codec.encode(message)
+            await participant.transport.send_message(payload, droppable)
+
+    async def join(self, transport: WebSocketBase, name: str = '') -> Optional[Participant]:
+        self.joining += 1
+        try:
+            return await self._join(transport, name)
+        finally:
+            self.joining -= 1
+
+    async def _join(self, transport: WebSocketBase, name: str) -> Optional[Participant]:
+        async with self._lock:
+            if self.pipeline is None:
+                entry = self.warm.take() if self.warm is not None else None
+                if entry is not None:
+                    self.session = entry.session
+                    self.pipeline = entry.pipeline
+                    self.spare = entry.endpoints
+                    self.lifetimes.acquire(self.pipeline, self)
+                    self.warm.handed_over(entry)
+
+            participant = Participant(self, transport, name)
+            plan = self._join_plan(participant)
+            try:
+                results = await plan.run()
+            except SetupFailed as e:
+                logger.error('Join of room %s failed: %s', self.room_id, e)
+                if not self.participants:
+                    # A warm pipeline taken for this join would otherwise stay held by an empty room
+                    await self.close()
+                return None
+            self.pipeline = results['pipeline']
+            participant.endpoint = results['endpoint']
+            participant.ice = results['ice']
+            self.lifetimes.acquire(self.pipeline, self)
+            self.lifetimes.acquire(participant.endpoint, participant)
+            self.participants[participant.participant_id] = participant
+
+        await participant.send({
+            'type': 'joined',
+            'room': self.room_id,
+            'participant': participant.participant_id,
+            'participants': [p.describe() for p in self.participants.values()],
+        })
+        await self.broadcast({'type': 'participantJoined', 'participant': participant.describe()},
+                             exclude=participant)
+        return participant
+
+    def _join_plan(self, participant: Participant) -> SetupPlan:
+        # ICE subscriptions and connects from every publisher only wait for the endpoint
+        plan = SetupPlan()
+        if self.pipeline is None:
+            plan.pipeline('pipeline', self.session)
+        else:
+            plan.value('pipeline', self.pipeline)
+        if self.spare:
+            plan.value('endpoint', self.spare.pop(), undo=lambda endpoint: endpoint.release())
+        else:
+            plan.endpoint('endpoint', 'pipeline', self.session)
+
+        async def start_ice(results: Dict) -> IceRelay:
+            ice = IceRelay(results['endpoint'], participant.send)
+            await ice.start()
+            return ice
+
+        plan.add('ice', start_ice, after=['endpoint'], undo=lambda ice: ice.close())
+        for publisher in self.participants.values():
+            if publisher.publishing:
+                plan.value(publisher.participant_id, publisher.endpoint)
+                plan.connect(f'connect {publisher.participant_id}', publisher.participant_id, 'endpoint')
+        return plan
+
+    async def publish(self, participant: Participant, offer: str):
+        answer = await participant.endpoint.process_offer(offer)
+        if answer is None:
+            await participant.send({'type': 'error', 'message': 'processOffer failed'})
+            return
+        await participant.send({'type': 'answer', 'sdp': answer})
+        await participant.endpoint.gather_candidates()
+
+        if not participant.publishing:
+            participant.publishing = True
+            subscribers = [p for p in self.participants.values() if p is not participant]
+            await asyncio.gather(*(participant.endpoint.connect(p.endpoint) for p in subscribers))
+            await self.broadcast({'type': 'newPublisher', 'participant': participant.describe()},
+                                 exclude=participant)
+
+    def endpoint_stats(self, collector: StatsCollector) -> Dict[str, Dict[str, float]]:
+        stats = {}
+        for participant in self.participants.values():
+            latest = collector.latest(participant.endpoint.object_id)
+            if latest is not None:
+                stats[participant.participant_id] = latest
+        return stats
+
+    async def push_stats(self, when: float, changes: Dict[str, Dict[str, float]]):
+        stats = {}
+        for participant in self.participants.values():
+            changed = changes.get(participant.endpoint.object_id)
+            if changed:
+                stats[participant.participant_id] = changed
+        if stats:
+            await self.broadcast({'type': 'stats', 'time': when, 'participants': stats}, droppable=True,
+                                 to=self.stats_subscribers)
+
+    async def leave(self, participant: Participant):
+        if self.participants.pop(participant.participant_id, None) is None:
+            return
+        self.stats_subscribers.discard(participant)
+        await participant.ice.close()
+        self.lifetimes.drop(participant)
+        await self.broadcast({'type': 'participantLeft', 'participant': participant.participant_id})
+
+    async def close(self):
+        if self.pipeline is not None:
+            self.lifetimes.drop(self)
+            self.pipeline = None
+            self.spare = []
+
+
+class RoomManager:
+    def __init__(self, session_for: Callable[[str], KurentoSession], warm: Optional[WarmPool] = None,
+                 lifetimes: Optional[Lifetimes] = None, admission: Optional[Admission] = None):
+        self.session_for = session_for
+        self.warm = warm
+        self.lifetimes = lifetimes or Lifetimes()
+        # Shared by every connection to this worker
+        self.admission = admission or Admission()
+        self.rooms: Dict[str, Room] = {}
+        self.stats_collector: Optional[StatsCollector] = None
+
+    def endpoints(self) -> List[WebRTCEndPoint]:
+        return [participant.endpoint for room in self.rooms.values() for participant in room.participants.values()]
+
+    async def push_stats(self, when: float, changes: Dict[str, Dict[str, float]]):
+        """StatsCollector listener: the changed fields go to the subscribers of each room."""
+        for room in list(self.rooms.values()):
+            if room.stats_subscribers:
+                await room.push_stats(when, changes)
+
+    def get(self, room_id: str) -> Room:
+        room = self.rooms.get(room_id)
+        if room is None:
+            room = self.rooms[room_id] = Room(room_id, self.session_for(room_id), warm=self.warm,
+                                              lifetimes=self.lifetimes)
+        return room
+
+    async def leave(self, participant: Participant):
+        room = participant.room
+        await room.leave(participant)
+        await self.discard(room)
+
+    async def discard(self, room: Room):
+        """Forget ``room`` if nobody is in it or joining it."""
+        if not room.participants and not room.joining and self.rooms.get(room.room_id) is room:
+            del self.rooms[room.room_id]
+            await room.close()
+
+    @property
+    def stats(self) -> List[Dict]:
+        return [{'room': room_id, 'participants': len(room)} for room_id, room in self.rooms.items()]
+
+
+class RoomProtocol(ReaderWriterBase):
+    """Browser side of a /ws connection.
+
+    Every message takes a token from the connection's bucket and joins go
+    through the rooms' JoinGate; what is not admitted gets a ``tryLater``.
+    """
+
+    traced = True
+    participant: Optional[Participant] = None
+    # Never rate limited, dropping them would leave Kurento objects behind
+    UNLIMITED = frozenset({'leave'})
+
+    def __init__(self, transport: WebSocketBase, rooms: RoomManager, router: Optional[WorkerRouter] = None):
+        super().__init__(transport)
+        self.rooms = rooms
+        self.router = router
+        self.bucket = rooms.admission.bucket()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await super().__aexit__(exc_type, exc_val, exc_tb)
+        if self.participant is not None:
+            await self.rooms.leave(self.participant)
+            self.participant = None
+
+    async def on_message(self, msg: Any):
+        try:
+            if msg.get('type') not in self.UNLIMITED and not self.bucket.take():
+                ADMISSION.labels('message', 'rate_limited').inc()
+                if msg.get('type') == 'join':
+                    await self.try_later(TryLater('too many messages', 1.0 / self.bucket.rate))
+                return
+            handler = getattr(self, 'on_' + str(msg.get('type')), None)
+            if handler is None:
+                logger.error('Unknown browser message: %s', msg)
+                return
+            await handler(msg)
+        except Exception:
+            logger.exception('!')
+
+    async def on_join(self, msg: Dict):
+        if self.participant is not None:
+            return
+        room_id = str(msg['room'])
+        if self.router is not None and not self.router.owns(room_id):
+            # Rooms live in one worker only; the client reconnects to the owner
+            await self.transport.send_message({
+                'type': 'redirect',
+                'url': self.router.url_for(room_id, self.transport.request.url.host),
+            })
+            return
+        joins = self.rooms.admission.joins
+        try:
+            await joins.enter()
+        except TryLater as e:
+            await self.try_later(e)
+            return
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        room: Optional[Room] = None
+        try:
+            # Creating the room picks its Kurento session, which fails too when every link is down
+            room = self.rooms.get(room_id)
+            self.participant = await room.join(self.transport, msg.get('name', ''))
+        except NoKurentoLink:
+            await self.try_later(TryLater('media server unavailable', joins.retry_after()))
+            return
+        finally:
+            joins.leave(loop.time() - start)
+            if self.participant is None and room is not None:
+                # A failed first join must not leave an empty room behind
+                await self.rooms.discard(room)
+        if self.participant is None:
+            await self.transport.send_message({'type': 'error', 'message': 'join failed'})
+
+    async def try_later(self, e: TryLater):
+        logger.info('Join refused: %s', e)
+        await self.transport.send_message({'type': 'tryLater', 'reason': e.reason,
+                                           'retryAfter': round(e.retry_after, 1)})
+
+    async def on_offer(self, msg: Dict):
+        if self.participant is not None:
+            await self.participant.room.publish(self.participant, msg['sdp'])
+
+    async def on_iceCandidate(self, msg: Dict):
+        if self.participant is not None:
+            self.participant.ice.add_remote_candidate(msg.get('candidate'))
+
+    async def on_subscribeStats(self, msg: Dict):
+        collector = self.rooms.stats_collector
+        if self.participant is None or collector is None:
+            return
+        room = self.participant.room
+        room.stats_subscribers.add(self.participant)
+        # Everything known so far; later pushes only carry what changed
+        await self.transport.send_message({'type': 'stats', 'time': time.time(), 'full': True,
+                                           'participants': room.endpoint_stats(collector)})
+
+    async def on_unsubscribeStats(self, msg: Dict):
+        if self.participant is not None:
+            self.participant.room.stats_subscribers.discard(self.participant)
+
+    async def on_chat(self, msg: Dict):
+        if self.participant is not None:
+            await self.participant.room.broadcast({
+                'type': 'chat',
+                'from': self.participant.participant_id,
+                'text': msg.get('text', ''),
+            })
+
+    async def on_leave(self, msg: Dict):
+        if self.participant is not None:
+            await self.rooms.leave(self.participant)
+            self.participant = None
@@ -0,0 +1,50 @@
+import bisect
+import hashlib
+from typing import Sequence, List, Tuple, Optional
+from urllib.parse import urlencode
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing with ``replicas`` virtual points per node."""
+
+    def __init__(self, nodes: Sequence[str], replicas: int = 64):
+        points: List[Tuple[int, str]] = sorted(
+            (_hash(f'{node}#{i}'), node) for node in nodes for i in range(replicas))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class WorkerRouter:
+    """Maps room ids to the worker process that owns them.
+
+    Every worker shares the public port and also listens on ``port + 1 + index``
+    so that a client can be sent to one particular worker.
+    """
+
+    def __init__(self, index: int, count: int, port: int, scheme: str = 'ws'):
+        self.index = index
+        self.count = count
+        self.port = port
+        self.scheme = scheme
+        self.ring = HashRing([str(i) for i in range(count)])
+
+    def owner(self, room_id: str) -> int:
+        return int(self.ring.node_for(room_id))
+
+    def owns(self, room_id: str) -> bool:
+        return self.owner(room_id) == self.index
+
+    def worker_port(self, index: int) -> int:
+        return self.port + 1 + index
+
+    def url_for(self, room_id: str, host: str, path: str = '/ws', scheme: Optional[str] = None) -> str:
+        port = self.worker_port(self.owner(room_id))
+        return f'{scheme or self.scheme}://{host}:{port}{path}?{urlencode({"room": room_id})}'
@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import logging
 from asyncio import Future
@@ -8,26 +9,32 @@ from typing import Dict, Awaitable
 import aiohttp
 from aiohttp import web
 
+from roomserver.admission import Admission
 from roomserver.jsonrpc import JsonRPC, send_custom_request
-from roomserver.media.pipeline import MediaPipeline
-from roomserver.media.session import KurentoSession, JsonRPCProtocol, JsonRPCBase
-from roomserver.media.web_rtc_endpoint import WebRTCEndPoint
-from roomserver.protocol import ReaderWriterBase
-from roomserver.runner import run_app
-from roomserver.transport import WebSocketResponse, WebSocketBase, WebSocketClient
+from roomserver.media.lifetime import Lifetimes
+from roomserver.media.pool import KurentoPool
+from roomserver.media.stats import StatsCollector, stats_adjust_handler, stats_handler
+from roomserver.media.warm import WarmPool
+from roomserver.metrics import metrics_handler, monitor_loop_lag, ROOMS, PARTICIPANTS
+from roomserver.tracing import tracer, traces_handler
+from roomserver.recording import Recorder
+from roomserver.room import RoomManager, RoomProtocol
+from roomserver.runner import run_app, run_workers
+from roomserver.transport import WebSocketResponse, WebSocketBase, WebSocketClient, LeanWebSocketResponse
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)40s - %(levelname)9s - %(message)s')
 logger = logging.getLogger('rs')
 
 
-class Echo(ReaderWriterBase):
-    async def on_message(self, msg):
-        await self.transport.send_message({'resp': 1})
-
-
 async def websocket_handler(request):
-    async with WebSocketResponse(request, raw=True) as response:
-        async with Echo(response):
+    router = request.app.get('router')
+    room_id = request.query.get('room')
+    if router is not None and room_id is not None and not router.owns(room_id):
+        raise web.HTTPTemporaryRedirect(router.url_for(room_id, request.url.host, scheme=request.scheme))
+    transport = LeanWebSocketResponse if request.app['ws_lean'] else WebSocketResponse
+    async with transport(request, deflate=request.app['ws_deflate'],
+                         deflate_window=request.app['ws_deflate_window']) as response:
+        async with RoomProtocol(response, request.app['rooms'], router):
             await response.run()
         # while True:
         #     await response.run(timeout=0.1)
@@ -62,24 +69,41 @@ async def websocket_handler(request):
 #             if not item:
 #                 break
 
-# TODO: global in app
-rpc_base = JsonRPCBase()
+KURENTO_URL = 'ws://127.0.0.1:8888/kurento'
+WARM_PIPELINES = 4
+# Kurento requests in flight over the whole pool; more wait in the worker
+MAX_IN_FLIGHT = 256
+SWEEP_INTERVAL = 300.0
+# Seconds between getStats rounds over all live endpoints
+STATS_INTERVAL = 5.0
+
 
 async def media_server(app):
     try:
-        async with WebSocketClient('ws://127.0.0.1:8888/kurento') as client:
-            async with JsonRPCProtocol(client, rpc_base) as protocol:
-                session = KurentoSession(protocol)
-                p = MediaPipeline(session)
-                await p.create()
-                wb = WebRTCEndPoint(p, session)
-                await wb.create()
-                try:
-                    await client.run()
-                except asyncio.CancelledError:
-                    logger.debug('media_server Canceled')
-                finally:
-                    logger.debug('media_server Finished')
+        async with KurentoPool(app['kurento_url'], size=4, max_in_flight=app['max_in_flight']) as pool:
+            app['kurento'] = pool
+            lifetimes = app['lifetimes']
+            router = app.get('router')
+            # A restarted worker gets the same tag and reclaims what its predecessor left behind
+            lifetimes.tag = f'{lifetimes.tag}:{router.index if router is not None else 0}'
+            sweeper = asyncio.create_task(lifetimes.run_sweeper(pool.session, SWEEP_INTERVAL))
+            warm = WarmPool(pool.session, size=WARM_PIPELINES, lifetimes=lifetimes)
+            app['warm'] = app['rooms'].warm = warm
+            rooms = app['rooms']
+            stats = StatsCollector(rooms.endpoints, app['stats_interval'], app['stats_jitter'], app['stats_history'])
+            stats.listeners.append(rooms.push_stats)
+            app['stats'] = rooms.stats_collector = stats
+            try:
+                async with warm, stats:
+                    # Links stay up until warm and lifetimes released their objects; the pool's exit cancels them
+                    await asyncio.shield(pool.run())
+            except asyncio.CancelledError:
+                logger.debug('media_server Canceled')
+            finally:
+                sweeper.cancel()
+                await asyncio.wait([sweeper])
+                await lifetimes.close()
+                logger.debug('media_server Finished')
     except Exception:
         logger.exception('!!!!!!')
 
@@ -131,6 +155,13 @@ async def media_server(app):
 async def start_background_tasks(app):
     logger.debug('Start')
     app['media_server'] = asyncio.create_task(media_server(app))
+    app['loop_lag'] = asyncio.create_task(monitor_loop_lag())
+    if app.get('record'):
+        router = app.get('router')
+        # One file per worker, connection ids are per recorder
+        path = app['record'] if router is None else f"{app['record']}.{router.index}"
+        WebSocketBase.recorder = Recorder(path)
+        WebSocketBase.recorder.start()
 
 
 async def cleanup_background_tasks(app):
@@ -139,6 +170,12 @@ async def cleanup_background_tasks(app):
 
     app['media_server'].cancel()
     await app['media_server']
+    app['loop_lag'].cancel()
+    await asyncio.wait([app['loop_lag']])
+    if WebSocketBase.recorder is not None:
+        await WebSocketBase.recorder.close()
+    if app.get('trace_dump'):
+        tracer.dump(app['trace_dump'])
 
     logger.debug('Stopped')
 
@@ -148,7 +185,25 @@ async def shutdown_runners(app):
 
 
 app = web.Application()
-app.add_routes([web.get('/ws', websocket_handler)])
+app['lifetimes'] = Lifetimes()
+app['ws_deflate'] = True
+app['ws_deflate_window'] = None
+app['ws_lean'] = False
+app['kurento_url'] = KURENTO_URL
+app['max_in_flight'] = MAX_IN_FLIGHT
+app['stats_interval'] = STATS_INTERVAL
+app['stats_jitter'] = 0.2
+app['stats_history'] = 60
+app['rooms'] = RoomManager(lambda room_id: app['kurento'].session(), lifetimes=app['lifetimes'])
+ROOMS.labels().set_function(lambda: len(app['rooms'].rooms))
+PARTICIPANTS.labels().set_function(lambda: sum(len(room) for room in app['rooms'].rooms.values()))
+app.add_routes([
+    web.get('/ws', websocket_handler),
+    web.get('/metrics', metrics_handler),
+    web.get('/traces', traces_handler),
+    web.get('/stats', stats_handler),
+    web.post('/stats', stats_adjust_handler),
+])
 app.on_startup.append(start_background_tasks)
 app.on_cleanup.append(cleanup_background_tasks)
 app.on_shutdown.append(shutdown_runners)
@@ -157,5 +212,46 @@ app.on_shutdown.append(shutdown_runners)
 if __name__ == '__main__':
     # app['gunicorn'] = False
     # asyncio.get_event_loop().set_debug(True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--trace-sample', type=float, default=0.0, help='share of browser messages traced')
+    parser.add_argument('--trace-slow', type=float, default=0.5, help='seconds after which a join trace is kept')
+    parser.add_argument('--trace-dump', help='append kept traces to this file on exit')
+    parser.add_argument('--no-ws-deflate', dest='ws_deflate', action='store_false',
+                        help='refuse permessage-deflate on /ws')
+    parser.add_argument('--ws-deflate-window', type=int, choices=range(9, 16), metavar='{9..15}',
+                        help='compress every /ws frame on its own with this window, no per-connection state')
+    parser.add_argument('--lean-ws', dest='ws_lean', action='store_true',
+                        help='no tasks or queues per idle /ws connection, for many mostly idle browsers')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='Kurento requests in flight')
+    parser.add_argument('--join-concurrency', type=int, default=16, help='joins set up at the same time')
+    parser.add_argument('--join-queue', type=int, default=256, help='joins waiting, more get tryLater')
+    parser.add_argument('--join-wait', type=float, default=5.0, help='seconds a join may wait')
+    parser.add_argument('--message-rate', type=float, default=20.0, help='browser messages per second per connection')
+    parser.add_argument('--message-burst', type=float, default=60.0, help='browser messages allowed in a burst')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between getStats rounds')
+    parser.add_argument('--stats-jitter', type=float, default=0.2, help='share of the interval rounds vary by')
+    parser.add_argument('--stats-history', type=int, default=60, help='samples kept per endpoint')
+    parser.add_argument('--kurento-url', default=KURENTO_URL, help='e.g. a roomserver.replay stand-in')
+    parser.add_argument('--record', metavar='PATH', help='append every WebSocket frame to this file')
+    args = parser.parse_args()
+    tracer.configure(sample_rate=args.trace_sample, slow_threshold=args.trace_slow)
+    app['trace_dump'] = args.trace_dump
+    app['record'] = args.record
+    app['kurento_url'] = args.kurento_url
+    app['ws_deflate'] = args.ws_deflate
+    app['ws_deflate_window'] = args.ws_deflate_window
+    app['ws_lean'] = args.ws_lean
+    app['max_in_flight'] = args.max_in_flight
+    app['stats_interval'] = args.stats_interval
+    app['stats_jitter'] = args.stats_jitter
+    app['stats_history'] = args.stats_history
+    app['rooms'].admission = Admission(args.join_concurrency, args.join_queue, args.join_wait,
+                                       rate=args.message_rate, burst=args.message_burst)
     with suppress(asyncio.CancelledError):
-        run_app(app)
+        if args.workers > 1:
+            run_workers(app, port=args.port, workers=args.workers)
+        else:
+            run_app(app, port=args.port)
@@ -1,9 +1,13 @@
 import asyncio
 import logging
+import os
+import signal
 import socket
 import sys
+import time
+from contextlib import suppress
 from ssl import SSLContext
-from typing import Union, Awaitable, Optional, Callable, Type
+from typing import Union, Awaitable, Optional, Callable, Type, List, Dict
 
 from aiohttp.abc import Application, AbstractAccessLogger
 from aiohttp.log import access_logger
@@ -11,6 +15,10 @@ from aiohttp.web import _run_app
 from aiohttp.web_log import AccessLogger
 from aiohttp.web_runner import GracefulExit
 
+from .routing import WorkerRouter
+
+logger = logging.getLogger(__name__)
+
 
 def run_app(app: Union[Application, Awaitable[Application]], *,
             host: Optional[str] = None,
@@ -62,3 +70,119 @@ def run_app(app: Union[Application, Awaitable[Application]], *,
         if sys.version_info >= (3, 6):
             loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
+
+
+def worker_sockets(host: str, port: int, router: WorkerRouter, backlog: int = 128) -> List[socket.socket]:
+    shared = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    shared.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    shared.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    shared.bind((host, port))
+    own = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    own.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    own.bind((host, router.worker_port(router.index)))
+    for sock in (shared, own):
+        sock.listen(backlog)
+        sock.setblocking(False)
+    return [shared, own]
+
+
+def run_workers(app: Application, *,
+                host: str = '0.0.0.0',
+                port: int = 8080,
+                workers: Optional[int] = None,
+                min_uptime: float = 10.0,
+                backoff: float = 1.0,
+                max_backoff: float = 30.0,
+                max_fast_exits: int = 5,
+                **kwargs) -> None:
+    """Run an app in N forked workers sharing one port
+
+    Workers are told apart by app['router'], which assigns every room to
+    exactly one of them. A worker that dies is started again with the same
+    index so that room ownership does not move. One that exits within
+    ``min_uptime`` seconds of starting is restarted after ``backoff`` seconds,
+    doubling up to ``max_backoff``; after ``max_fast_exits`` such exits in a
+    row its index is given up.
+    """
+    workers = workers or os.cpu_count() or 1
+    children: Dict[int, int] = {}
+    started: Dict[int, float] = {}
+    fast_exits: Dict[int, int] = {}
+    # Index -> time.monotonic() at which it is started again
+    restarts: Dict[int, float] = {}
+    stopping = False
+
+    def spawn(index: int):
+        started[index] = time.monotonic()
+        pid = os.fork()
+        if pid:
+            children[pid] = index
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            router = WorkerRouter(index, workers, port)
+            app['router'] = router
+            run_app(app, sock=worker_sockets(host, port, router), **kwargs)
+        except (asyncio.CancelledError, GracefulExit, KeyboardInterrupt):
+            pass
+        except BaseException:
+            logger.exception('Worker %s failed', index)
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        restarts.clear()
+        for pid in children:
+            with suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGINT)
+
+    def exited(pid: int, status: int):
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            return
+        if time.monotonic() - started[index] < min_uptime:
+            fast_exits[index] = fast_exits.get(index, 0) + 1
+        else:
+            fast_exits[index] = 0
+        count = fast_exits[index]
+        if count >= max_fast_exits:
+            logger.error('Worker %s (pid %s) exited with %s, %s times in a row within %ss of starting; '
+                         'not restarting it', index, pid, status, count, min_uptime)
+            return
+        delay = min(max_backoff, backoff * 2 ** (count - 1)) if count else 0.0
+        logger.warning('Worker %s (pid %s) exited with %s, restarting in %.1fs', index, pid, status, delay)
+        restarts[index] = time.monotonic() + delay
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(workers):
+        spawn(index)
+    while children or restarts:
+        now = time.monotonic()
+        for index, when in list(restarts.items()):
+            if when <= now:
+                del restarts[index]
+                spawn(index)
+        if not restarts:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:  # pragma: no cover
+                continue
+            exited(pid, status)
+            continue
+        # A restart is due: reap without blocking past it
+        pid = 0
+        if children:
+            with suppress(ChildProcessError):
+                pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            exited(pid, status)
+        else:
+            time.sleep(min(0.1, max(0.0, min(restarts.values(), default=now) - now)))
@@ -0,0 +1,116 @@
+import collections
+import contextvars
+import enum
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .flow import FlowControl, FlowControlQueue, payload_size
+from .metrics import OUTBOUND_WAIT
+
+
+class Priority(enum.IntEnum):
+    """Class of an outbound Kurento request, most urgent first."""
+    # Signalling a participant is waiting on: offers, ICE candidates, releases
+    INTERACTIVE = 0
+    NORMAL = 1
+    # Stats polling, warm pool refills, orphan sweeps
+    BACKGROUND = 2
+
+
+# Priority of requests sent by the current task when the call site sets none
+current: contextvars.ContextVar[Priority] = contextvars.ContextVar('priority', default=Priority.NORMAL)
+
+# Seconds the head of a lane may wait before it is served ahead of more urgent lanes
+MAX_WAIT: Dict[Priority, float] = {
+    Priority.INTERACTIVE: 0.0,
+    Priority.NORMAL: 0.05,
+    Priority.BACKGROUND: 0.5,
+}
+
+
+class _Lanes:
+    """One FIFO of (item, size, queued at) per Priority; sized like the deque it replaces."""
+
+    __slots__ = ('lanes', 'count')
+
+    def __init__(self):
+        self.lanes: List[Deque[Tuple[Any, int, float]]] = [collections.deque() for _ in Priority]
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+
+class ScheduledQueue(FlowControlQueue):
+    """FlowControlQueue that hands out the most urgent message first.
+
+    Messages are put with a Priority and kept in one FIFO per class. ``get``
+    serves the most urgent non empty lane, except that a lane whose head has
+    waited longer than its ``max_wait`` is served first, so background traffic
+    is delayed but never starved. Interactive messages are still queued while
+    the producer is paused, up to the flow's ``max_size``.
+    """
+
+    def __init__(self, flow: Optional[FlowControl] = None, wait=None, peer: str = 'kurento',
+                 max_wait: Optional[Dict[Priority, float]] = None):
+        super().__init__(flow, wait)
+        self.max_wait = dict(MAX_WAIT if max_wait is None else max_wait)
+        self.promoted = 0
+        self._waits = [OUTBOUND_WAIT.labels(peer, priority.name.lower()) for priority in Priority]
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._queue = _Lanes()
+
+    def _put(self, entry):
+        priority, item = entry
+        size = payload_size(item)
+        self._queue.lanes[priority].append((item, size, time.monotonic()))
+        self._queue.count += 1
+        self._grew(size)
+
+    def _get(self):
+        now = time.monotonic()
+        priority = self._next(now)
+        item, size, queued = self._queue.lanes[priority].popleft()
+        self._queue.count -= 1
+        self._shrank(size)
+        self.last_wait = now - queued
+        if self.wait is not None:
+            self.wait.observe(self.last_wait)
+        self._waits[priority].observe(self.last_wait)
+        return item
+
+    def _next(self, now: float) -> Priority:
+        urgent = None
+        overdue = None
+        late = 0.0
+        for priority, lane in zip(Priority, self._queue.lanes):
+            if not lane:
+                continue
+            if urgent is None:
+                urgent = priority
+                continue
+            # Of the lanes past their max_wait the one furthest past it goes first
+            over = now - lane[0][2] - self.max_wait[priority]
+            if over > late:
+                overdue, late = priority, over
+        if overdue is not None:
+            self.promoted += 1
+            return overdue
+        return urgent
+
+    def put_nowait(self, item, priority: Priority = Priority.NORMAL):
+        super().put_nowait((priority, item))
+
+    async def put(self, item, droppable: Optional[bool] = None, priority: Priority = Priority.NORMAL) -> bool:
+        if priority != Priority.INTERACTIVE or self.qsize() >= self.flow.max_size:
+            if not await self._admit(item, droppable):
+                return False
+        self.put_nowait(item, priority)
+        return True
+
+    @property
+    def stats(self) -> Dict:
+        depth = {priority.name.lower(): len(lane) for priority, lane in zip(Priority, self._queue.lanes)}
+        return {'depth': depth, 'bytes': self.bytes, 'promoted': self.promoted, 'dropped': self.dropped}
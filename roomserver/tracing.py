@@ -0,0 +1,217 @@
+import asyncio
+import collections
+import contextvars
+import json
+import logging
+import random
+import time
+import uuid
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Trace of the browser message being handled by the current task
+current: contextvars.ContextVar[Optional['Trace']] = contextvars.ContextVar('trace', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'start', 'end', 'parent', 'attrs')
+
+    def __init__(self, name: str, start: float, end: Optional[float], parent: Optional[int], attrs: Dict):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.parent = parent
+        self.attrs = attrs
+
+
+class Trace:
+    """Spans of one browser message; span 0 covers the whole handler."""
+
+    def __init__(self, name: str, start: float, sampled: bool, attrs: Dict):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.wall_time = time.time() - (time.monotonic() - start)
+        self.sampled = sampled
+        self.spans: List[Span] = [Span(name, start, None, None, attrs)]
+
+    @property
+    def name(self) -> str:
+        return self.spans[0].name
+
+    @property
+    def duration(self) -> float:
+        root = self.spans[0]
+        return (root.end or time.monotonic()) - root.start
+
+    def span(self, name: str, start: float, end: Optional[float] = None, parent: int = 0, **attrs) -> int:
+        self.spans.append(Span(name, start, end, parent, attrs))
+        return len(self.spans) - 1
+
+    def finish(self):
+        self.spans[0].end = time.monotonic()
+
+    def to_dict(self) -> Dict:
+        origin = self.spans[0].start
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'time': self.wall_time,
+            'duration_ms': round(self.duration * 1e3, 3),
+            'spans': [{
+                'id': index,
+                'parent': span.parent,
+                'name': span.name,
+                'start_ms': round((span.start - origin) * 1e3, 3),
+                'duration_ms': None if span.end is None else round((span.end - span.start) * 1e3, 3),
+                **span.attrs,
+            } for index, span in enumerate(self.spans)],
+        }
+
+
+class RpcTrace:
+    """Timestamps of one traced Kurento request, turned into spans when it completes."""
+
+    __slots__ = ('trace', 'label', 'r_id', 'started', 'admitted', 'written', 'received', 'replied')
+
+    def __init__(self, trace: Trace, label: str, r_id: int, started: float):
+        self.trace = trace
+        self.label = label
+        self.r_id = r_id
+        self.started = started
+        self.admitted = time.monotonic()
+        self.written: Optional[float] = None
+        self.received: Optional[float] = None
+        self.replied: Optional[float] = None
+
+    def reply(self, queue_wait: float):
+        self.replied = time.monotonic()
+        self.received = self.replied - queue_wait
+
+    def done(self, future: asyncio.Future):
+        end = time.monotonic()
+        if future.cancelled():
+            outcome = 'cancelled'
+        elif future.exception() is not None:
+            outcome = type(future.exception()).__name__
+        else:
+            outcome = 'ok'
+        trace = self.trace
+        parent = trace.span(f'kurento {self.label}', self.started, end, rpc_id=self.r_id, outcome=outcome)
+        trace.span('admission', self.started, self.admitted, parent)
+        if self.written is not None:
+            trace.span('send queue', self.admitted, self.written, parent)
+            if self.received is not None:
+                trace.span('kms', self.written, self.received, parent)
+                trace.span('reply queue', self.received, self.replied, parent)
+
+
+# Traced requests by id() of the dict queued on the socket, until the sender writes them
+pending_writes: Dict[int, RpcTrace] = {}
+
+
+def written(item: Any):
+    now = time.monotonic()
+    for request in item if isinstance(item, list) else (item,):
+        rpc = pending_writes.pop(id(request), None)
+        if rpc is not None:
+            rpc.written = now
+
+
+def trace_request(trace: Trace, traced: Dict[int, RpcTrace], label: str, request: Dict,
+                  future: asyncio.Future, started: float):
+    rpc = RpcTrace(trace, label, request['id'], started)
+    pending_writes[id(request)] = rpc
+    traced[request['id']] = rpc
+
+    def done(f: asyncio.Future):
+        pending_writes.pop(id(request), None)
+        traced.pop(rpc.r_id, None)
+        rpc.done(f)
+
+    future.add_done_callback(done)
+
+
+class Tracer:
+    """Decides which browser messages are traced and keeps the finished traces.
+
+    A ``sample_rate`` share of messages is traced and kept. Message types in
+    ``always`` are traced every time but only kept when they take at least
+    ``slow_threshold`` seconds, so every slow join has a waterfall. Finished
+    traces go to a ring buffer of ``capacity`` entries.
+    """
+
+    def __init__(self, sample_rate: float = 0.0, capacity: int = 1024, slow_threshold: float = 0.5,
+                 always: Iterable[str] = ('join',)):
+        self.traces: Deque[Trace] = collections.deque(maxlen=capacity)
+        self.configure(sample_rate, capacity, slow_threshold, always)
+
+    def configure(self, sample_rate: Optional[float] = None, capacity: Optional[int] = None,
+                  slow_threshold: Optional[float] = None, always: Optional[Iterable[str]] = None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if capacity is not None and capacity != self.traces.maxlen:
+            self.traces = collections.deque(self.traces, maxlen=capacity)
+        if slow_threshold is not None:
+            self.slow_threshold = slow_threshold
+        if always is not None:
+            self.always = frozenset(always)
+
+    def start(self, message_type: str, queue_wait: float = 0.0, **attrs) -> Optional[Trace]:
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and message_type not in self.always:
+            return None
+        now = time.monotonic()
+        trace = Trace(f'ws {message_type}', now - queue_wait, sampled, attrs)
+        trace.span('browser queue', now - queue_wait, now)
+        return trace
+
+    def finish(self, trace: Trace):
+        trace.finish()
+        if trace.sampled or trace.duration >= self.slow_threshold:
+            self.traces.append(trace)
+            if not trace.sampled:
+                logger.info('Slow %s (%.0f ms), trace %s', trace.name, trace.duration * 1e3, trace.trace_id)
+
+    def export(self, min_duration: float = 0.0, name: Optional[str] = None) -> List[Dict]:
+        return [trace.to_dict() for trace in list(self.traces)
+                if trace.duration >= min_duration and (name is None or trace.name == name)]
+
+    def dump(self, path: str):
+        with open(path, 'a') as f:
+            for trace in self.export():
+                f.write(json.dumps(trace) + '\n')
+
+
+tracer = Tracer()
+
+
+def waterfall(trace: Dict, width: int = 60) -> str:
+    total = trace['duration_ms'] or 1e-3
+    depth = {0: 0}
+    lines = [f"{trace['name']} {trace['trace_id']} {total:.3f} ms"]
+    for span in trace['spans']:
+        if span['parent'] is not None:
+            depth[span['id']] = depth.get(span['parent'], 0) + 1
+        duration = span['duration_ms'] or 0.0
+        offset = int(span['start_ms'] / total * width)
+        bar = ' ' * offset + '#' * max(1, int(duration / total * width))
+        label = '  ' * depth[span['id']] + span['name']
+        lines.append(f'{label:40.40} {bar:{width}.{width}} {duration:9.3f} ms')
+    return '\n'.join(lines)
+
+
+async def traces_handler(request: web.Request) -> web.Response:
+    """Finished traces as JSON, or as text waterfalls with ``?format=text``.
+
+    ``?min_ms=`` keeps only traces at least that long, ``?name=ws%20join`` one message type.
+    """
+    try:
+        min_ms = float(request.query.get('min_ms', 0))
+    except ValueError:
+        raise web.HTTPBadRequest(text='min_ms must be a number')
+    traces = tracer.export(min_ms / 1e3, request.query.get('name'))
+    if request.query.get('format') == 'text':
+        return web.Response(text='\n\n'.join(waterfall(trace) for trace in traces) + '\n')
+    return web.json_response({'traces': traces})
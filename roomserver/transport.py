@@ -1,12 +1,21 @@
 import asyncio
 import logging
+import struct
 from asyncio import Task
-from typing import Optional, Union, Dict, Iterable, Set
+from typing import Any, Awaitable, Callable, Optional, Union, Dict, Iterable, Set, List, Tuple
 
 import aiohttp
 from aiohttp import web
 from aiohttp.client import _WSRequestContextManager
 
+from . import tracing
+from .codec import FrameCodec, Payload, SUBPROTOCOLS, subprotocol_codec
+from .flow import FlowControl, FlowControlQueue, SlowConsumer, SlowConsumerPolicy
+from .metrics import TimedQueue, QUEUE_WAIT, QUEUE_DEPTH, WS_BYTES, WS_CONNECTION_BYTES, WS_OPEN, WS_RTT, WS_DEAD, \
+    WS_FRAMING
+from .recording import Kind, Recorder
+from .scheduling import Priority, ScheduledQueue
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,16 +29,104 @@ def results_dispose(tasks: Iterable[Task]):
             logger.exception('Task raised: %s', task)
 
 
+async def send_payload(ws: Union[web.WebSocketResponse, aiohttp.ClientWebSocketResponse], payload: Payload,
+                       binary: bool = False, compress: Optional[int] = None):
+    if isinstance(payload, str):
+        await ws.send_str(payload, compress=compress)
+    elif binary:
+        await ws.send_bytes(payload, compress=compress)
+    elif hasattr(ws, 'send_frame'):
+        # Encoded bytes go out as a text frame without a decode/encode round trip
+        await ws.send_frame(payload, aiohttp.WSMsgType.TEXT, compress=compress)
+    else:
+        await ws.send_str(payload.decode(), compress=compress)
+
+
+def pong_rtt(data: bytes, now: float) -> Optional[float]:
+    # Our pings carry the send time; pongs to anybody else's are ignored
+    if len(data) != 8:
+        return None
+    return now - struct.unpack('!d', data)[0]
+
+
+def wire_size(payload: Union[str, bytes]) -> int:
+    # Text frames go out as UTF-8; isascii() is a flag check, so ASCII text is not encoded twice
+    if isinstance(payload, str) and not payload.isascii():
+        return len(payload.encode())
+    return len(payload)
+
+
+def write_blocked(ws: web.WebSocketResponse, limit: int) -> bool:
+    """True if a write to ``ws`` may wait for the peer to read: paused, or over ``limit`` bytes unsent."""
+    writer = ws._writer
+    if writer is None:
+        return False
+    transport = writer.transport
+    return writer.protocol._paused or (transport is not None and transport.get_write_buffer_size() > limit)
+
+
+def browser_socket(deflate: bool) -> web.WebSocketResponse:
+    # Pings and pongs are handled by the receiver, which also measures the RTT
+    return web.WebSocketResponse(autoping=False, protocols=tuple(SUBPROTOCOLS), compress=deflate)
+
+
+def negotiated_framing(ws: web.WebSocketResponse, codec: FrameCodec,
+                       deflate_window: Optional[int]) -> Tuple[FrameCodec, Optional[int]]:
+    """Codec and per-frame deflate window of a prepared browser socket."""
+    if ws.ws_protocol is not None:
+        codec = subprotocol_codec(ws.ws_protocol)
+    frame_compress = None
+    if ws.compress and deflate_window:
+        # The browser may have asked for a smaller window than ours
+        frame_compress = min(deflate_window, ws.compress)
+    WS_FRAMING.labels(codec.name, 'deflate' if ws.compress else 'none').inc()
+    return codec, frame_compress
+
+
 class WebSocketBase:
     ws: Union[web.WebSocketResponse, aiohttp.ClientWebSocketResponse]
     sender_task: Task
     receiver_task: Task
+    keepalive_task: Optional[Task] = None
     runners: Set[Task] = set()
+    # Open sockets by peer label, for the queue depth gauges
+    sockets: Dict[str, Set['WebSocketBase']] = {}
+    peer = 'websocket'
+    # Lean transports have no inbound queue and call ``handler`` themselves
+    lean = False
+    # Window bits of a fresh deflate context per frame, None for the negotiated shared one
+    frame_compress: Optional[int] = None
+    # Scheduled transports serve outbound messages by Priority instead of in order
+    scheduled = False
+    # Every socket opened while set records its frames; record_id is the socket's connection there
+    recorder: Optional[Recorder] = None
+    record_id = 0
 
-    def __init__(self, raw: bool = False):
-        self.inbound_queue = asyncio.Queue()
-        self.outbound_queue = asyncio.Queue()
+    def __init__(self, raw: bool = False, codec: Optional[FrameCodec] = None,
+                 flow: Optional[FlowControl] = None, inbound_maxsize: int = 256,
+                 ping_interval: Optional[float] = None, ping_timeout: Optional[float] = None):
+        # A full inbound queue stops the receiver, which leaves the rest in the socket buffers
+        self.inbound_queue = TimedQueue(inbound_maxsize, QUEUE_WAIT.labels(self.peer, 'in'))
+        if self.scheduled:
+            self.outbound_queue = ScheduledQueue(flow, QUEUE_WAIT.labels(self.peer, 'out'), self.peer)
+        else:
+            self.outbound_queue = FlowControlQueue(flow, QUEUE_WAIT.labels(self.peer, 'out'))
         self.raw = raw
+        self.codec = codec or FrameCodec()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._bytes_in_total = WS_BYTES.labels(self.peer, 'in')
+        self._bytes_out_total = WS_BYTES.labels(self.peer, 'out')
+        # With a ping interval the peer is declared dead after ping_timeout seconds of silence
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout or (ping_interval and ping_interval * 2.5)
+        self.rtt: Optional[float] = None
+        self.last_seen = 0.0
+        self.dead = False
+        self._rtt = WS_RTT.labels(self.peer)
+
+    async def send_payload(self, payload: Payload):
+        await send_payload(self.ws, payload, self.codec.binary, self.frame_compress)
 
     async def sender(self):
         while True:
@@ -39,17 +136,84 @@ class WebSocketBase:
                     logger.debug('media_server_sender Received End')
                     break
                 # logger.debug('media_server_sender sending %s', str(item))
-                await self.ws.send_json(item)
+                payload = item if isinstance(item, (str, bytes)) else await self.codec.encode(item)
+                size = wire_size(payload)
+                self.bytes_out += size
+                self._bytes_out_total.inc(size)
+                if self.record_id:
+                    self.recorder.frame(self.record_id, Kind.OUT, payload)
+                await self.send_payload(payload)
+                if tracing.pending_writes:
+                    tracing.written(item)
             finally:
                 self.outbound_queue.task_done()
 
     async def receiver(self):
+        loop = asyncio.get_event_loop()
         async for msg in self.ws:  # type: aiohttp.WSMessage
-            # TODO: msg.type == aiohttp.WSMsgType.ERROR:
-            await self.inbound_queue.put(msg.json() if not self.raw else msg.data)
+            self.last_seen = loop.time()
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                logger.error('Websocket error: %s', self.ws.exception())
+                break
+            if msg.type == aiohttp.WSMsgType.PING:
+                await self.ws.pong(msg.data)
+                continue
+            if msg.type == aiohttp.WSMsgType.PONG:
+                self.on_pong(msg.data, loop.time())
+                continue
+            size = wire_size(msg.data)
+            self.bytes_in += size
+            self._bytes_in_total.inc(size)
+            if self.record_id:
+                self.recorder.frame(self.record_id, Kind.IN, msg.data)
+            await self.inbound_queue.put(await self.codec.decode(msg.data) if not self.raw else msg.data)
+
+    def on_pong(self, data: bytes, now: float):
+        rtt = pong_rtt(data, now)
+        if rtt is not None:
+            self.rtt = rtt
+            self._rtt.observe(rtt)
+
+    async def keepalive(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            silent = loop.time() - self.last_seen
+            if silent > self.ping_timeout:
+                logger.warning('%s peer silent for %.1fs, closing', self.peer, silent)
+                self.dead = True
+                WS_DEAD.labels(self.peer).inc()
+                self.disconnect()
+                return
+            try:
+                await self.ws.ping(struct.pack('!d', loop.time()))
+            except ConnectionError:
+                # The receiver notices the closed socket by itself
+                return
+
+    @property
+    def closed(self) -> bool:
+        return self.sender_task.done()
 
-    async def send_message(self, data: Dict):
-        await self.outbound_queue.put(data)
+    def depth(self, direction: str) -> int:
+        return (self.inbound_queue if direction == 'in' else self.outbound_queue).qsize()
+
+    async def send_message(self, data: Union[Dict, List[Dict], Payload], droppable: Optional[bool] = None,
+                           priority: Optional[Priority] = None) -> bool:
+        if self.closed:
+            return False
+        try:
+            if priority is not None and self.scheduled:
+                return await self.outbound_queue.put(data, droppable, priority)
+            return await self.outbound_queue.put(data, droppable)
+        except SlowConsumer as e:
+            logger.warning('Disconnecting slow consumer: %s', e)
+            self.disconnect()
+            return False
+
+    def disconnect(self):
+        if not self.sender_task.done():
+            self.sender_task.cancel()
 
     async def _run(self, timeout: Optional[float] = None):
         tasks = {self.receiver_task, self.sender_task}
@@ -66,28 +230,72 @@ class WebSocketBase:
         for runner in cls.runners:
             runner.cancel()
 
+    @classmethod
+    def _peer_sockets(cls, peer: str) -> Set['WebSocketBase']:
+        open_sockets = cls.sockets.get(peer)
+        if open_sockets is None:
+            # Gauges are read at scrape time instead of being updated on every put/get
+            open_sockets = cls.sockets[peer] = set()
+            WS_OPEN.labels(peer).set_function(lambda: len(open_sockets))
+            QUEUE_DEPTH.labels(peer, 'in').set_function(lambda: sum(s.depth('in') for s in open_sockets))
+            QUEUE_DEPTH.labels(peer, 'out').set_function(lambda: sum(s.depth('out') for s in open_sockets))
+        return open_sockets
+
     async def __aenter__(self):
+        self.last_seen = asyncio.get_event_loop().time()
+        if self.recorder is not None:
+            self.record_id = self.recorder.open(self.peer, self.codec.name)
         self.sender_task = asyncio.create_task(self.sender())
         self.receiver_task = asyncio.create_task(self.receiver())
+        if self.ping_interval:
+            self.keepalive_task = asyncio.create_task(self.keepalive())
+        self._peer_sockets(self.peer).add(self)
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         tasks = {self.receiver_task, self.sender_task}
+        if self.keepalive_task is not None:
+            tasks.add(self.keepalive_task)
         for task in tasks:
-            if self.sender_task.done():
+            # The receiver of a silent peer would otherwise wait forever
+            if task.done():
                 continue
             task.cancel()
         await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
         results_dispose(tasks)
+        if self.record_id:
+            self.recorder.close_connection(self.record_id)
+        if self in self.sockets[self.peer]:
+            self.sockets[self.peer].discard(self)
+            WS_CONNECTION_BYTES.labels(self.peer, 'in').observe(self.bytes_in)
+            WS_CONNECTION_BYTES.labels(self.peer, 'out').observe(self.bytes_out)
 
 
 class WebSocketResponse(WebSocketBase):
-    def __init__(self, request, **kwargs):
+    """Browser side of /ws.
+
+    The framing is negotiated per connection: a subprotocol from SUBPROTOCOLS
+    picks the codec (JSON text frames without one), and permessage-deflate is
+    accepted when the browser offers it and ``deflate`` is set. With
+    ``deflate_window`` every frame is compressed on its own with that many
+    window bits, which keeps no deflate state per connection but compresses
+    small messages worse than the shared context.
+    """
+
+    peer = 'browser'
+
+    def __init__(self, request, deflate: bool = True, deflate_window: Optional[int] = None, **kwargs):
+        # A stalled browser must not hold up the room
+        kwargs.setdefault('flow', FlowControl(SlowConsumerPolicy.DROP))
+        kwargs.setdefault('ping_interval', 15.0)
         super().__init__(**kwargs)
         self.request = request
+        self.deflate = deflate
+        self.deflate_window = deflate_window
 
     async def __aenter__(self):
-        self.ws = web.WebSocketResponse()
+        self.ws = browser_socket(self.deflate)
         await self.ws.prepare(self.request)
+        self.codec, self.frame_compress = negotiated_framing(self.ws, self.codec, self.deflate_window)
         await super().__aenter__()
         return self
 
@@ -95,22 +303,288 @@ class WebSocketResponse(WebSocketBase):
         await super().__aexit__(exc_type, exc_val, exc_tb)
 
 
+class Pinger:
+    """Pings a group of sockets from one task instead of a keepalive task per socket."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.sockets: Set['LeanWebSocketResponse'] = set()
+        self.task: Optional[Task] = None
+
+    def add(self, socket: 'LeanWebSocketResponse'):
+        self.sockets.add(socket)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def discard(self, socket: 'LeanWebSocketResponse'):
+        self.sockets.discard(socket)
+        if not self.sockets and self.task is not None:
+            # Cleared first, a socket added meanwhile starts a task of its own
+            task, self.task = self.task, None
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            for socket in list(self.sockets):
+                await socket.ping(now)
+
+
+class LeanWebSocketResponse:
+    """Browser side of /ws for many mostly idle connections.
+
+    Nothing runs per connection while it is idle. ``run`` reads in the
+    handler's own task and passes every message straight to ``handler``, which
+    makes the socket the back pressure instead of an inbound queue. Writes go
+    out directly; only while one is in flight, or while the peer is not
+    reading, are further messages queued, with the usual flow control, and
+    drained by a sender task that exits with the backlog, so no caller waits
+    for a stalled browser. One Pinger per interval pings all lean sockets.
+    """
+
+    __slots__ = ('request', 'ws', 'codec', 'flow', 'deflate', 'deflate_window', 'frame_compress', 'handler',
+                 'ping_timeout', 'pinger', 'rtt', 'last_seen', 'dead', 'bytes_in', 'bytes_out',
+                 'record_id', '_backlog', '_sender', '_writing', '_closed', '_task')
+
+    peer = 'browser'
+    lean = True
+    pingers: Dict[float, Pinger] = {}
+
+    def __init__(self, request, codec: Optional[FrameCodec] = None, flow: Optional[FlowControl] = None,
+                 ping_interval: Optional[float] = 15.0, ping_timeout: Optional[float] = None,
+                 deflate: bool = True, deflate_window: Optional[int] = None):
+        self.request = request
+        self.codec = codec or FrameCodec()
+        # A stalled browser must not hold up the room
+        self.flow = flow or FlowControl(SlowConsumerPolicy.DROP)
+        self.deflate = deflate
+        self.deflate_window = deflate_window
+        self.frame_compress: Optional[int] = None
+        self.handler: Optional[Callable[[Any, float], Awaitable]] = None
+        self.pinger = None
+        if ping_interval:
+            self.pinger = self.pingers.get(ping_interval)
+            if self.pinger is None:
+                self.pinger = self.pingers[ping_interval] = Pinger(ping_interval)
+        self.ping_timeout = ping_timeout or (ping_interval and ping_interval * 2.5)
+        self.rtt: Optional[float] = None
+        self.last_seen = 0.0
+        self.dead = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._backlog: Optional[FlowControlQueue] = None
+        self._sender: Optional[Task] = None
+        self._writing = False
+        self._closed = False
+        self._task: Optional[Task] = None
+        self.record_id = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def depth(self, direction: str) -> int:
+        return self._backlog.qsize() if direction == 'out' and self._backlog is not None else 0
+
+    async def send_message(self, data: Union[Dict, List[Dict], Payload], droppable: Optional[bool] = None) -> bool:
+        if self._closed:
+            return False
+        if self._writing or write_blocked(self.ws, self.flow.high_bytes):
+            if self._backlog is None:
+                self._backlog = FlowControlQueue(self.flow, QUEUE_WAIT.labels(self.peer, 'out'))
+            try:
+                queued = await self._backlog.put(data, droppable)
+            except SlowConsumer as e:
+                logger.warning('Disconnecting slow consumer: %s', e)
+                self.disconnect()
+                return False
+            if not self._writing:
+                # The peer is not reading; its sender waits for the drain, the caller never does
+                self._writing = True
+                self._sender = asyncio.create_task(self._drain())
+            return queued
+        self._writing = True
+        try:
+            await self._write(data)
+        except Exception as e:
+            # The caller is usually somebody else's handler, it must not see this socket's errors
+            logger.debug('Write to browser failed: %r', e)
+            self._writing = False
+            self.disconnect()
+            return False
+        if self._backlog is not None and not self._backlog.empty():
+            # Whatever queued up meanwhile goes out in order, by a sender that exits with the backlog
+            self._sender = asyncio.create_task(self._drain())
+        else:
+            self._backlog = None
+            self._writing = False
+        return True
+
+    async def _write(self, item: Any):
+        payload = item if isinstance(item, (str, bytes)) else await self.codec.encode(item)
+        size = wire_size(payload)
+        self.bytes_out += size
+        WS_BYTES.labels(self.peer, 'out').inc(size)
+        if self.record_id:
+            WebSocketBase.recorder.frame(self.record_id, Kind.OUT, payload)
+        await send_payload(self.ws, payload, self.codec.binary, self.frame_compress)
+
+    async def _drain(self):
+        backlog = self._backlog
+        try:
+            while not backlog.empty():
+                item = backlog.get_nowait()
+                try:
+                    await self._write(item)
+                finally:
+                    backlog.task_done()
+        except Exception as e:
+            logger.debug('Write to browser failed: %r', e)
+            self.disconnect()
+        finally:
+            self._backlog = None
+            self._sender = None
+            self._writing = False
+
+    async def ping(self, now: float):
+        if self._closed:
+            return
+        silent = now - self.last_seen
+        if silent > self.ping_timeout:
+            logger.warning('%s peer silent for %.1fs, closing', self.peer, silent)
+            self.dead = True
+            WS_DEAD.labels(self.peer).inc()
+            self.disconnect()
+            return
+        if self._writing or write_blocked(self.ws, self.flow.high_bytes):
+            # Busy sockets are not idle, and a ping must not wait behind their backlog or for a
+            # stalled peer; the Pinger serves every lean socket from one task
+            return
+        try:
+            await self.ws.ping(struct.pack('!d', now))
+        except Exception as e:
+            logger.debug('Ping failed: %r', e)
+
+    def disconnect(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._sender is not None:
+            self._sender.cancel()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def run(self, timeout: Optional[float] = None):
+        if self._closed:
+            return
+        task = self._task = asyncio.current_task()
+        WebSocketBase.runners.add(task)
+        try:
+            if timeout is None:
+                # wait_for would wrap the loop in a task of its own
+                await self.receive()
+            else:
+                await asyncio.wait_for(self.receive(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # Cancelled by disconnect, anything else goes on
+            if not self._closed:
+                raise
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+        finally:
+            WebSocketBase.runners.discard(self._task)
+            self._task = None
+
+    async def receive(self):
+        loop = asyncio.get_event_loop()
+        bytes_in = WS_BYTES.labels(self.peer, 'in')
+        async for msg in self.ws:  # type: aiohttp.WSMessage
+            self.last_seen = loop.time()
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                logger.error('Websocket error: %s', self.ws.exception())
+                break
+            if msg.type == aiohttp.WSMsgType.PING:
+                await self.ws.pong(msg.data)
+                continue
+            if msg.type == aiohttp.WSMsgType.PONG:
+                rtt = pong_rtt(msg.data, loop.time())
+                if rtt is not None:
+                    self.rtt = rtt
+                    WS_RTT.labels(self.peer).observe(rtt)
+                continue
+            size = wire_size(msg.data)
+            self.bytes_in += size
+            bytes_in.inc(size)
+            if self.record_id:
+                WebSocketBase.recorder.frame(self.record_id, Kind.IN, msg.data)
+            if self.handler is not None:
+                await self.handler(await self.codec.decode(msg.data), 0.0)
+            if self._closed:
+                break
+
+    async def __aenter__(self):
+        self.ws = browser_socket(self.deflate)
+        await self.ws.prepare(self.request)
+        self.codec, self.frame_compress = negotiated_framing(self.ws, self.codec, self.deflate_window)
+        self.last_seen = asyncio.get_event_loop().time()
+        if WebSocketBase.recorder is not None:
+            self.record_id = WebSocketBase.recorder.open(self.peer, self.codec.name)
+        WebSocketBase._peer_sockets(self.peer).add(self)
+        if self.pinger is not None:
+            self.pinger.add(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._closed = True
+        if self.pinger is not None:
+            await self.pinger.discard(self)
+        # A drain still writing must not outlive the response
+        sender = self._sender
+        if sender is not None:
+            sender.cancel()
+            await asyncio.wait([sender])
+        if self.record_id:
+            WebSocketBase.recorder.close_connection(self.record_id)
+        open_sockets = WebSocketBase.sockets[self.peer]
+        if self in open_sockets:
+            open_sockets.discard(self)
+            WS_CONNECTION_BYTES.labels(self.peer, 'in').observe(self.bytes_in)
+            WS_CONNECTION_BYTES.labels(self.peer, 'out').observe(self.bytes_out)
+
+
 class WebSocketClient(WebSocketBase):
+    peer = 'kurento'
+    scheduled = True
     session: aiohttp.ClientSession
     ws_cm: _WSRequestContextManager
 
-    def __init__(self, url: str):
-        super().__init__()
+    def __init__(self, url: str, **kwargs):
+        kwargs.setdefault('ping_interval', 5.0)
+        super().__init__(**kwargs)
         self.url = url
 
     async def __aenter__(self):
         self.session = await aiohttp.ClientSession().__aenter__()
-        self.ws_cm = self.session.ws_connect(self.url)
-        self.ws = await self.ws_cm.__aenter__()
+        self.ws_cm = self.session.ws_connect(self.url, autoping=False)
+        try:
+            self.ws = await self.ws_cm.__aenter__()
+        except BaseException:
+            # Reconnect loops would otherwise leak a ClientSession per attempt
+            await self.session.close()
+            raise
         await super().__aenter__()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await super().__aexit__(exc_type, exc_val, exc_tb)
-        await self.ws_cm.__aexit__(exc_type, exc_val, exc_tb)
+        try:
+            # A dead peer will not answer the close frame; closing the session drops the socket
+            await asyncio.wait_for(self.ws_cm.__aexit__(exc_type, exc_val, exc_tb), 0.1 if self.dead else None)
+        except asyncio.TimeoutError:
+            pass
         await self.session.__aexit__(exc_type, exc_val, exc_tb)